@@ -5,14 +5,13 @@ This submodule contains the core classes for use in the deferred charge simulati
 
 To Do:
     * Maybe add changes to check if lmfit parameters.
-    * Change the initialize. Traps should not carry a pixel array dependent on
-      unknown amplifier geometry.
 
 """
 
 import numpy as np
 import copy
 from astropy.io import fits
+from scipy.interpolate import interp1d
 
 class SerialTrap:
     """Represents a serial register trap.
@@ -44,45 +43,219 @@ class SerialTrap:
             raise ValueError('Pixel must be type int.')
         self.pixel = pixel
 
-        self._trap_array = None
         self._trapped_charge = None
-
-    @property
-    def trap_array(self):
-        return self._trap_array
+        self._release_fraction = None
+        self._capture_table = None
+        self._trapped_tangents = None
 
     @property
     def trapped_charge(self):
         return self._trapped_charge
 
-    def initialize(self, ny, nx, prescan_width):
-        """Initialize trapping arrays for simulated readout."""
-
-        if self.pixel > nx+prescan_width:
+    @classmethod
+    def stack(cls, traps):
+        """Combine serial traps into a single trap with parameter arrays.
+
+        The parameters of the returned trap have shape `(len(traps), 1)`, so the
+        trap simulates every parameter set at once along a leading batch axis.
+
+        Args:
+            traps ('list' of 'SerialTrap'): Serial traps of the same type and location.
+
+        Returns:
+            SerialTrap.
+
+        Raises:
+            ValueError: If the traps differ in type, location, or spline interpolant.
+        """
+        stacked_trap = copy.copy(traps[0])
+        for trap in traps:
+            if type(trap) is not type(stacked_trap) or trap.pixel != stacked_trap.pixel:
+                raise ValueError('Stacked traps must have the same type and pixel location.')
+            if stacked_trap.parameter_keywords is None and trap.f is not stacked_trap.f:
+                raise ValueError('Stacked traps must share the same trapping function.')
+
+        for keyword in stacked_trap.parameter_names():
+            values = np.asarray([getattr(trap, keyword) for trap in traps], dtype=np.float64)
+            setattr(stacked_trap, keyword, values[:, None])
+        stacked_trap._trapped_charge = None
+        stacked_trap._release_fraction = None
+        stacked_trap._capture_table = None
+        stacked_trap._trapped_tangents = None
+
+        return stacked_trap
+
+    def parameter_names(self):
+        """Return the names of the trap size, emission time and trapping function parameters."""
+
+        return ['size', 'emission_time'] + (self.parameter_keywords or [])
+
+    def cache_key(self):
+        """Return a hashable key identifying the trap type, location and parameters.
+
+        Spline traps are identified by their interpolant object.
+        """
+        values = tuple(np.asarray(getattr(self, keyword), dtype=np.float64).tobytes()
+                       for keyword in self.parameter_names())
+        key = (type(self).__name__, self.pixel, values)
+        if self.parameter_keywords is None:
+            key += (self.f,)
+
+        return key
+
+    def initialize(self, ny, nx, prescan_width, dtype=np.float64, max_signal=None,
+                   table_size=None):
+        """Initialize trapped charge state for simulated readout.
+
+        The trap only occupies a single serial pixel, so the trapped charge
+        is stored as a single column with one entry per row, of floating 
+        point type `dtype`.  If `table_size` is given, the trapping function 
+        is tabulated at `table_size` evenly spaced signals from 0 to `max_signal`
+        and evaluated by linear interpolation during readout (see `tabulate`).
+        """
+
+        if self.pixel >= nx+prescan_width:
             raise ValueError('Trap location {0} must be less than {1}'.format(self.pixel,
                                                                               nx+prescan_width))
 
-        self._trap_array = np.zeros((ny, nx+prescan_width))
-        self._trap_array[:, self.pixel] = self.size
-        self._trapped_charge = np.zeros((ny, nx+prescan_width))
+        ## Stacked traps carry an additional leading batch axis
+        batch_shape = np.shape(self.size)[:-1]
+        self._trapped_charge = np.zeros(batch_shape+(ny,), dtype=dtype)
+        self._release_fraction = 1-np.exp(-1./self.emission_time)
+
+        if table_size is None:
+            self._capture_table = None
+        else:
+            self.tabulate(max_signal, table_size, dtype=dtype)
+
+    def tabulate(self, max_signal, table_size, dtype=np.float64):
+        """Tabulate the trapping function for evaluation by linear interpolation.
+
+        The trapping function is evaluated at `table_size` evenly spaced signals 
+        from 0 to `max_signal`.  Signals outside this range take the value at 
+        the nearest end of the table.  The interpolation error is largest at 
+        kinks of the trapping function, such as the saturation of a `LinearTrap`,
+        where it is of order `scaling*max_signal/table_size`.
+
+        Args:
+            max_signal (float): Largest tabulated signal [e-].
+            table_size (int): Number of tabulated signals.
+            dtype (numpy.dtype): Floating point type of the table.
+        """
+        if table_size < 2:
+            raise ValueError('Table size must be at least 2.')
+        max_signal = max(float(max_signal), np.finfo(np.float32).tiny)
+        signals = np.linspace(0., max_signal, table_size)
+        values = np.broadcast_to(self.f(signals), np.shape(self.size)[:-1]+(table_size,))
+        values = np.asarray(values, dtype=dtype)
+        slopes = np.diff(values, axis=-1)
+
+        self._capture_table = ((table_size-1)/max_signal, values, slopes)
+
+    def capture_function(self, pixel_signals):
+        """Evaluate the trapping function, interpolating the table if tabulated."""
+
+        if self._capture_table is None:
+            return self.f(pixel_signals)
+
+        scale, values, slopes = self._capture_table
+        x = np.clip(pixel_signals*scale, 0, slopes.shape[-1])
+        i = np.minimum(x.astype(np.intp), slopes.shape[-1]-1)
+        x -= i
+        if values.ndim == 1:
+            return values[i] + x*slopes[i]
+        else:
+            return (np.take_along_axis(values, i, axis=-1) 
+                    + x*np.take_along_axis(slopes, i, axis=-1))
 
     def release_charge(self):
         """Release charge through exponential decay."""
         
-        released_charge = self._trapped_charge*(1-np.exp(-1./self.emission_time))
+        released_charge = self._trapped_charge*self._release_fraction
         self._trapped_charge -= released_charge
 
         return released_charge
 
     def trap_charge(self, free_charge):
-        """Perform charge capture using a logistic function."""
+        """Perform charge capture on the pixel column at the trap location."""
 
-        captured_charge = np.clip(self.f(free_charge), self.trapped_charge, 
-                                  self._trap_array) - self.trapped_charge
+        captured_charge = np.clip(self.capture_function(free_charge), self.trapped_charge, 
+                                  self.size) - self.trapped_charge
         self._trapped_charge += captured_charge
 
         return captured_charge
 
+    def initialize_tangents(self, index, num_tangents):
+        """Initialize trapped charge derivatives for simulated readout.
+
+        The trapped charge is held in the first entry of a leading axis, followed 
+        by its derivatives with respect to `num_tangents` parameters, and `index`
+        maps each parameter name of the trap (see `parameter_names`) to its entry.
+        Must follow `initialize`.
+        """
+        self._tangent_index = index
+        self._trapped_tangents = np.zeros((num_tangents+1,)+self._trapped_charge.shape)
+        self._trapped_charge = self._trapped_tangents[0]
+        self._size_tangent = np.zeros((num_tangents+1, 1))
+        self._size_tangent[0] = self.size
+        self._size_tangent[index['size']] = 1.
+
+    def trap_charge_tangents(self, free_charge):
+        """Perform charge capture, propagating derivatives of the charge.
+
+        The trapping function is evaluated directly, not from a table.  Where
+        the trapping function equals the trapped charge or the trap size, the
+        derivative of the trapping function is used.
+
+        Args:
+            free_charge (numpy.ndarray): Pixel column at the trap location [e-],
+                followed by its derivatives along the leading axis.
+
+        Returns:
+            NumPy array of the captured charge, followed by its derivatives.
+        """
+        trapped = self._trapped_tangents
+        signals = free_charge[0]
+
+        capture = self.f(signals)
+        derivative, partials = self.f_derivatives(signals)
+        tangents = derivative*free_charge
+        tangents[0] = capture
+        for keyword, partial in partials.items():
+            tangents[self._tangent_index[keyword]] += partial
+
+        ## Capture is clipped between the trapped charge and the trap size
+        np.copyto(tangents, trapped, where=capture < trapped[0])
+        np.copyto(tangents, self._size_tangent, where=capture > self.size)
+        captured_charge = tangents - trapped
+        trapped += captured_charge
+
+        return captured_charge
+
+    def release_charge_tangents(self):
+        """Release charge through exponential decay, propagating derivatives.
+
+        Returns:
+            NumPy array of the released charge, followed by its derivatives.
+        """
+        trapped = self._trapped_tangents
+        released_charge = trapped*self._release_fraction
+        released_charge[self._tangent_index['emission_time']] -= \
+            trapped[0]*np.exp(-1./self.emission_time)/self.emission_time**2
+        trapped -= released_charge
+
+        return released_charge
+
+    def f_derivatives(self, pixel_signals):
+        """Calculate derivatives of the charge trapping function.
+
+        Returns:
+            Tuple of the derivative with respect to the pixel signals and a 
+            dictionary of the derivatives with respect to the trap parameters.
+        """
+
+        raise NotImplementedError
+
     def capture(self):
         """Trap capture function."""
 
@@ -103,6 +276,18 @@ class LinearTrap(SerialTrap):
 
         return np.minimum(self.size, pixel_signals*self.scaling)
 
+    def f_derivatives(self, pixel_signals):
+        """Calculate derivatives of the charge trapping function.
+
+        At saturation, the derivative of the saturated trap is used.
+        """
+        saturated = self.size <= pixel_signals*self.scaling
+        derivative = np.where(saturated, 0., self.scaling)
+        partials = {'size' : np.where(saturated, 1., 0.),
+                    'scaling' : np.where(saturated, 0., pixel_signals)}
+
+        return derivative, partials
+
 class LogisticTrap(SerialTrap):
 
     parameter_keywords = ['f0', 'k']
@@ -118,6 +303,17 @@ class LogisticTrap(SerialTrap):
         
         return self.size/(1.+np.exp(-self.k*(pixel_signals-self.f0)))
 
+    def f_derivatives(self, pixel_signals):
+        """Calculate derivatives of the charge trapping function."""
+
+        logistic = 1./(1.+np.exp(-self.k*(pixel_signals-self.f0)))
+        slope = self.size*logistic*(1.-logistic)
+        partials = {'size' : logistic,
+                    'f0' : -self.k*slope,
+                    'k' : (pixel_signals-self.f0)*slope}
+
+        return self.k*slope, partials
+
 class SplineTrap(SerialTrap):
 
     parameter_keywords = None
@@ -128,8 +324,58 @@ class SplineTrap(SerialTrap):
         super().__init__(200000., emission_time, pixel)
         self.f = interpolant
 
+    @classmethod
+    def from_table(cls, signals, trapped_charges, emission_time, pixel):
+        """Create a trap from a table of the trapping function.
+
+        The trapping function is the linear interpolation of the trapped charge 
+        over the tabulated signals.  Signals outside the table, such as read 
+        noise below the first tabulated signal, take the trapped charge at the
+        nearest end of the table.
+
+        Args:
+            signals (numpy.ndarray): Increasing pixel signals [e-].
+            trapped_charges (numpy.ndarray): Trapped charge at each signal [e-].
+            emission_time (float): Trap emission time constant [1/transfers].
+            pixel (int): Serial pixel location of trap.
+
+        Returns:
+            SplineTrap.
+        """
+        trapped_charges = np.asarray(trapped_charges, dtype=np.float64)
+        interpolant = interp1d(np.asarray(signals, dtype=np.float64), trapped_charges,
+                               bounds_error=False, 
+                               fill_value=(trapped_charges[0], trapped_charges[-1]))
+
+        return cls(interpolant, emission_time, pixel)
+
+    def table(self):
+        """Return the tabulated signals and trapped charges of the trapping function.
+
+        The interpolant must hold its table as `x` and `y` attributes, as
+        `scipy.interpolate.interp1d` does.
+        """
+
+        return np.asarray(self.f.x), np.asarray(self.f.y)
+
+    def f_derivatives(self, pixel_signals):
+        """Calculate derivatives of the charge trapping function.
+
+        The derivative with respect to the pixel signals is the slope of the 
+        tabulated segment holding each signal (see `table`), or zero outside 
+        the table, and the trapping function does not depend on the trap size.
+        """
+        signals, trapped_charges = self.table()
+        slopes = np.diff(trapped_charges)/np.diff(signals)
+        i = np.clip(np.searchsorted(signals, pixel_signals, side='right')-1, 0, 
+                    slopes.shape[0]-1)
+        outside = (pixel_signals < signals[0]) | (pixel_signals > signals[-1])
+
+        return np.where(outside, 0., slopes[i]), {}
+
 class BaseOutputAmplifier:
 
+    parameter_keywords = ['gain', 'noise', 'global_offset']
     do_local_offset = False
 
     def __init__(self, gain, noise=0.0, global_offset=0.0):
@@ -138,6 +384,36 @@ class BaseOutputAmplifier:
         self.noise = noise
         self.global_offset = global_offset
 
+    @classmethod
+    def stack(cls, output_amplifiers):
+        """Combine output amplifiers into a single amplifier with parameter arrays.
+
+        The parameters of the returned amplifier have shape `(len(output_amplifiers), 1, 1)`,
+        so the amplifier simulates every parameter set at once along a leading batch axis
+        of images.
+
+        Args:
+            output_amplifiers ('list' of 'BaseOutputAmplifier'): Output amplifiers
+                of the same type.
+
+        Returns:
+            BaseOutputAmplifier.
+
+        Raises:
+            ValueError: If the output amplifiers differ in type.
+        """
+        stacked_amplifier = copy.copy(output_amplifiers[0])
+        for output_amplifier in output_amplifiers:
+            if type(output_amplifier) is not type(stacked_amplifier):
+                raise ValueError('Stacked output amplifiers must have the same type.')
+
+        for keyword in stacked_amplifier.parameter_keywords:
+            values = np.asarray([getattr(output_amplifier, keyword) 
+                                 for output_amplifier in output_amplifiers], dtype=np.float64)
+            setattr(stacked_amplifier, keyword, values[:, None, None])
+
+        return stacked_amplifier
+
 class FloatingOutputAmplifier(BaseOutputAmplifier):
     """Object representing the readout amplifier of a single channel.
 
@@ -149,6 +425,7 @@ class FloatingOutputAmplifier(BaseOutputAmplifier):
         drift_size (float): Strength of bias drift exponential.
         drift_tau (float): Decay time constant for bias drift.
     """
+    parameter_keywords = BaseOutputAmplifier.parameter_keywords + ['scale', 'decay_time']
     do_local_offset = True
     
     def __init__(self, gain, scale, decay_time, noise=0.0, offset=0.0):
@@ -163,6 +440,65 @@ class FloatingOutputAmplifier(BaseOutputAmplifier):
         
         return np.maximum(new, old*np.exp(-1/self.decay_time))
 
+    def local_offsets(self, signals):
+        """Calculate local offset hysteresis for a sequence of output pixel signals.
+
+        The local offset of each pixel is the largest scaled signal of the 
+        preceding pixels, decayed by `exp(-1/decay_time)` per pixel, which is the
+        result of applying `local_offset` pixel by pixel from a zero offset.
+
+        Args:
+            signals (numpy.ndarray): Output pixel signals [e-], in readout order
+                along the last axis.
+
+        Returns:
+            NumPy array.
+        """
+        offsets = decayed_running_maximum(self.scale*np.asarray(signals, dtype=np.float64),
+                                          self.decay_time)
+
+        return offsets.astype(np.result_type(signals, np.float32), copy=False)
+
+    def local_offset_tangents(self, signals, signal_tangents, index):
+        """Calculate local offsets and their derivatives for a sequence of output pixel signals.
+
+        Each local offset of `local_offsets` is the scaled signal of an earlier
+        pixel, decayed over the pixels since, and its derivatives follow from
+        those of that pixel signal.  Where the scaled signal equals the decayed 
+        offset, the scaled signal is used.
+
+        Args:
+            signals (numpy.ndarray): Output pixel signals [e-], in readout order
+                along the last axis.
+            signal_tangents (numpy.ndarray): Derivatives of the output pixel 
+                signals, along a leading axis.
+            index (dict): Entries of the derivatives with respect to `scale` and
+                `decay_time` along the leading axis.
+
+        Returns:
+            Tuple of the local offsets and their derivatives.
+        """
+        signals = np.asarray(signals, dtype=np.float64)
+        scaled_signals = self.scale*signals
+        offsets = decayed_running_maximum(scaled_signals, self.decay_time)
+
+        ## Pixel holding the scaled signal of each local offset
+        x = np.arange(signals.shape[-1])
+        decayed = np.zeros(offsets.shape)
+        decayed[..., 1:] = offsets[..., :-1]*np.exp(-1/self.decay_time)
+        source = np.maximum.accumulate(np.where(scaled_signals >= decayed, x, -1), axis=-1)
+        age = x - source
+
+        source_tangents = self.scale*signal_tangents
+        source_tangents[index['scale']] += signals
+        tangents = np.take_along_axis(source_tangents, 
+                                      np.broadcast_to(np.maximum(source, 0), signal_tangents.shape),
+                                      axis=-1)
+        tangents *= np.where(source >= 0, np.exp(-age/self.decay_time), 0.)
+        tangents[index['decay_time']] += offsets*age/self.decay_time**2
+
+        return offsets, tangents
+
     def update_parameters(self, scale, decay_time):
         """Update parameter values, if within acceptable values."""
 
@@ -174,3 +510,41 @@ class FloatingOutputAmplifier(BaseOutputAmplifier):
         if np.isnan(decay_time):
             raise ValueError("Decay time must be real-valued number, not NaN.")
         self.decay_time = decay_time
+
+def decayed_running_maximum(values, decay_time, max_exponent=500.):
+    """Calculate the running maximum of values that decay exponentially.
+
+    Each result is the largest of zero and the preceding values along the last
+    axis, with each value decayed by `exp(-1/decay_time)` per pixel since it 
+    occurred; i.e. the recurrence `y[x] = max(values[x], y[x-1]*exp(-1/decay_time))` 
+    from `y[-1] = 0`.  It is evaluated as a cumulative maximum of exponentially 
+    weighted values, over blocks of pixels short enough that the weights stay 
+    below `exp(max_exponent)`.
+
+    Args:
+        values (numpy.ndarray): Values, in pixel order along the last axis.
+        decay_time (float or numpy.ndarray): Decay time constant [pixels].
+        max_exponent (float): Largest exponent of the pixel weights.
+
+    Returns:
+        NumPy array.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    num_pixels = values.shape[-1]
+    decay_time = np.asarray(decay_time)
+    block_width = max(1, min(num_pixels, int(max_exponent*np.min(decay_time))))
+    k = np.arange(block_width)
+    weights = np.exp(k/decay_time)
+    carry_decay = np.exp(-(k+1)/decay_time)
+
+    result = np.empty(np.broadcast(values, weights[..., :1]).shape)
+    carry = np.zeros(result.shape[:-1]+(1,))
+    for start in range(0, num_pixels, block_width):
+        stop = min(start+block_width, num_pixels)
+        m = stop - start
+        block = np.maximum.accumulate(values[..., start:stop]*weights[..., :m], axis=-1)
+        np.maximum(block/weights[..., :m], carry*carry_decay[..., :m], 
+                   out=result[..., start:stop])
+        carry = result[..., stop-1:stop]
+
+    return result
@@ -4,26 +4,69 @@ To Do:
     * Rename module to something better.
     * Test out new trap operator that takes SerialTraps as args (rather than trap params).
 """
+import copy
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from scipy.linalg import solve_banded
 from scipy.sparse import dia_matrix
 from scipy.sparse.linalg import inv
-from scipy.special import comb
 
-def cti_inverse_operator(cti, ncols):
-    """Calculate a sparse matrix representing CTI operator."""
+from ctisim.core import BaseOutputAmplifier, FloatingOutputAmplifier, decayed_running_maximum
+from ctisim.image import ReadoutPlan
+
+@lru_cache(maxsize=64)
+def cti_operator_bands(cti, ncols):
+    """Calculate the diagonals of the lower-triangular CTI operator.
 
+    The result holds the main diagonal and the first two subdiagonals in the 
+    banded storage used by `scipy.linalg.solve_banded` with `(2, 0)` bands, 
+    which is also the layout of `scipy.sparse.dia_matrix` with offsets 
+    `[0, -1, -2]`.  Results are cached per CTI and number of columns, and are
+    returned read-only.
+    """
     b = cti
     a = 1-cti
+    i = np.arange(1, ncols+1)
 
-    diags = np.asarray([[a**i for i in range(1, ncols+1)],
-                        [i*b*(a**i) for i in range(1, ncols+1)],
-                        [comb(i+1, i-1)*(a**i)*(b**2.) for i in range(1, ncols+1)]])
+    bands = np.asarray([a**i, i*b*(a**i), (i+1)*i/2.*(a**i)*(b**2.)])
+    bands.setflags(write=False)
+
+    return bands
+
+def cti_inverse_operator(cti, ncols, dtype=np.float64):
+    """Calculate a sparse matrix representing CTI operator."""
+
+    diags = cti_operator_bands(float(cti), int(ncols)).astype(dtype)
 
     D = dia_matrix((diags, [0, -1, -2]), shape=(ncols, ncols))
     invD = inv(D)
 
     return invD
 
+def cti_correction(pixel_signals, cti):
+    """Apply the inverse CTI operator to every row of an image.
+
+    The inverse is applied by a banded lower-triangular solve with all image
+    rows as right-hand sides, rather than by forming the inverse matrix.
+    This is equivalent to multiplying each row by `cti_inverse_operator`.
+
+    Args:
+        pixel_signals (numpy.ndarray): Image pixel signals, with the serial 
+            register along the last axis.
+        cti (float): Proportional loss per pixel transfer.
+
+    Returns:
+        NumPy array.
+    """
+    pixel_signals = np.asarray(pixel_signals)
+    ny, ncols = pixel_signals.shape
+    bands = cti_operator_bands(float(cti), ncols)
+
+    corrected = solve_banded((2, 0), bands, pixel_signals.T, check_finite=False)
+
+    return corrected.T.astype(np.result_type(pixel_signals, np.float32), copy=False)
+
 def trap_inverse_operator(pixel_signals, *traps):
     """Calculate trapping inverse operator for given serial traps."""
 
@@ -38,28 +81,258 @@ def trap_inverse_operator(pixel_signals, *traps):
     S_estimate = pixel_signals # modify for pixel estimate
     
     C = f(S_estimate)
-    R = np.zeros(C.shape)
-    R[:, 1:] = f(S_estimate)[:, :-1]
+    R = np.zeros(C.shape, dtype=np.result_type(C, np.float32))
+    R[:, 1:] = C[:, :-1]
     T = R - C
     
     return T
 
 def electronics_inverse_operator(pixel_signals, scale, tau, 
                                  num_previous_pixels=4):
-    """Calculate electronics inverse operator for given parameterization."""
+    """Calculate electronics inverse operator for given parameterization.
 
-    r = np.exp(-1/tau)
+    The local offset of each pixel is the largest of the scaled signals of the
+    pixel and the preceding pixels in its row, decayed by `exp(-1/tau)` per pixel.
+    With `num_previous_pixels` set to None the full row history is used, 
+    evaluated as a running maximum; otherwise only the pixel and its
+    `num_previous_pixels-1` predecessors are included.  Memory use is a small
+    multiple of the image size in either case.
 
-    ny, nx = pixel_signals.shape
+    Args:
+        pixel_signals (numpy.ndarray): Image pixel signals [e-], with the 
+            serial register along the last axis.
+        scale (float): Local offset drift scale.
+        tau (float): Local offset decay time [pixels].
+        num_previous_pixels (int): Number of pixels included in the offset,
+            or None for the full row history.
 
-    offset = np.zeros((num_previous_pixels, ny, nx))
-    offset[0, :, :] = scale*np.maximum(0, pixel_signals[:, :])
+    Returns:
+        NumPy array.
+    """
+    pixel_signals = np.asarray(pixel_signals)
+    dtype = np.result_type(pixel_signals, np.float32)
+    scaled_signals = scale*np.maximum(0, pixel_signals)
 
-    for n in range(1, num_previous_pixels):
-        offset[n, :, n:] = scale*np.maximum(0, pixel_signals[:, :-n])*(r**(n))
+    if num_previous_pixels is None:
+        return decayed_running_maximum(scaled_signals, tau).astype(dtype, copy=False)
 
-    L = np.amax(offset, axis=0)
+    ## Running maximum over a truncated window, shifted one pixel at a time
+    r = np.exp(-1/tau)
+    nx = pixel_signals.shape[-1]
+    L = scaled_signals.astype(dtype)
+    decayed_signals = np.empty(L.shape, dtype=dtype)
+    for n in range(1, min(num_previous_pixels, nx)):
+        np.multiply(scaled_signals[..., :-n], r**n, out=decayed_signals[..., n:])
+        np.maximum(L[..., n:], decayed_signals[..., n:], out=L[..., n:])
 
     return L
+
+class DeferredChargeCorrector:
+    """Applies deferred charge correction to segment images.
+
+    The electronics, serial trap and CTI corrections are applied in turn to 
+    one block of image rows at a time, so that the intermediate arrays of each
+    stage stay small.  The trapping functions of the serial traps are evaluated
+    once per pixel.
+
+    Attributes:
+        cti (float): Proportional loss per pixel transfer.
+        drift_scale (float): Local offset drift scale.
+        decay_time (float): Local offset decay time [pixels].
+        traps ('list' of 'SerialTrap'): Serial traps, or None.
+        num_previous_pixels (int): Number of pixels included in the local 
+            offset, or None for the full row history.
+        do_cti (bool): Specifies inclusion of CTI correction.
+        block_rows (int): Number of image rows corrected at a time.
+    """
+
+    def __init__(self, cti=0.0, drift_scale=0.0, decay_time=2.4, traps=None, 
+                 num_previous_pixels=15, do_cti=True, block_rows=256):
+
+        self.cti = cti
+        self.drift_scale = drift_scale
+        self.decay_time = decay_time
+        if traps is not None and not isinstance(traps, list):
+            traps = [traps]
+        self.traps = traps
+        self.num_previous_pixels = num_previous_pixels
+        self.do_cti = do_cti
+        self.block_rows = block_rows
+        self._plan = None
+
+    @classmethod
+    def from_parameter_results(cls, parameter_results, ampnum, traps=None, **kwargs):
+        """Create a corrector from overscan parameter results for an amplifier.
+
+        Args:
+            parameter_results (OverscanParameterResults): Fit parameter results.
+            ampnum (int): Amplifier number.
+            traps ('list' of 'SerialTrap'): Serial traps of the amplifier.
+            **kwargs: Additional `DeferredChargeCorrector` arguments.
+
+        Returns:
+            DeferredChargeCorrector.
+        """
+        corrector = cls(cti=parameter_results.cti_results[ampnum],
+                        drift_scale=parameter_results.drift_scales[ampnum],
+                        decay_time=parameter_results.decay_times[ampnum],
+                        traps=traps, **kwargs)
+
+        return corrector
+
+    def correct(self, imarr, out=None):
+        """Correct an image for deferred charge.
+
+        Args:
+            imarr (numpy.ndarray): Image pixel signals [e-], with the serial 
+                register along the last axis.
+            out (numpy.ndarray): Optional output array, which may be `imarr` 
+                to correct the image in place.
+
+        Returns:
+            NumPy array.
+        """
+        imarr = np.asarray(imarr)
+        if out is None:
+            out = np.empty(imarr.shape, dtype=np.result_type(imarr, np.float32))
+        ny = imarr.shape[0]
+
+        for start in range(0, ny, self.block_rows):
+            block = imarr[start:start+self.block_rows]
+            corrected = out[start:start+self.block_rows]
+
+            ## Electronics correction
+            if self.drift_scale > 0.:
+                L = electronics_inverse_operator(block, self.drift_scale, self.decay_time,
+                                                 num_previous_pixels=self.num_previous_pixels)
+                np.subtract(block, L, out=corrected)
+            elif not np.shares_memory(corrected, block):
+                corrected[...] = block
+
+            ## Trap correction
+            if self.traps is not None:
+                C = self.trapped_charge(corrected)
+                T = -C
+                T[:, 1:] += C[:, :-1]
+                T *= 1-self.cti
+                corrected -= T
+
+            ## CTI correction
+            if self.do_cti and self.cti > 0.:
+                corrected[...] = cti_correction(corrected, self.cti)
+
+        return out
+
+    def iterative_correct(self, imarr, tol=0.01, max_iterations=20, out=None):
+        """Correct an image for deferred charge by iterating a forward readout model.
+
+        Starting from the result of `correct`, the estimate of the image before
+        readout is repeatedly read out with the serial readout model and updated
+        by the difference between the observed image and the readout, until the
+        largest absolute difference falls below `tol`.  The readout model is a
+        `ReadoutPlan` held by the corrector, so its work buffers are reused 
+        between iterations and between images of the same shape.  The estimate,
+        readout and differences are evaluated in double precision, as single 
+        precision rounding alone exceeds `tol` at high signals; the corrected
+        image has the floating point type of `correct`.
+
+        Args:
+            imarr (numpy.ndarray): Image pixel signals [e-], with the serial 
+                register along the last axis.
+            tol (float): Convergence tolerance on the largest residual [e-].
+            max_iterations (int): Maximum number of readout model evaluations.
+            out (numpy.ndarray): Optional output array, which may be `imarr` 
+                to correct the image in place.
+
+        Returns:
+            Tuple of the corrected NumPy array and a dictionary reporting the
+            number of `iterations`, the `max_residual` [e-] and whether the 
+            correction `converged`.
+        """
+        imarr = np.asarray(imarr)
+        observed = imarr.astype(np.float64, copy=out is imarr)
+        estimate = self.correct(observed)
+
+        plan = self.readout_plan()
+        forward = plan.buffer('forward', estimate.shape, estimate.dtype)
+        residual = plan.buffer('residual', estimate.shape, estimate.dtype)
         
+        converged = False
+        for iteration in range(1, max_iterations+1):
+            plan.execute(estimate, out=forward, no_noise=True)
+            np.subtract(observed, forward, out=residual)
+            max_residual = float(np.max(np.abs(residual)))
+            if max_residual < tol:
+                converged = True
+                break
+            estimate += residual
+
+        report = {'iterations' : iteration, 'max_residual' : max_residual, 
+                  'converged' : converged}
+
+        if out is None:
+            out = estimate.astype(np.result_type(imarr, np.float32), copy=False)
+        else:
+            out[...] = estimate
+
+        return out, report
+
+    def readout_plan(self):
+        """Return the serial readout model of the corrector, updated to its parameters."""
+
+        if self.drift_scale > 0.:
+            output_amplifier = FloatingOutputAmplifier(1.0, self.drift_scale, 
+                                                       self.decay_time)
+        else:
+            output_amplifier = BaseOutputAmplifier(1.0)
+        if self.traps is None:
+            traps = None
+        else:
+            traps = [copy.copy(trap) for trap in self.traps]
+        cti = self.cti if self.do_cti else 0.0
+
+        if self._plan is None:
+            self._plan = ReadoutPlan(cti, output_amplifier, traps=traps,
+                                     serial_overscan_width=0)
+        else:
+            self._plan.update(cti, output_amplifier, traps=traps)
+
+        return self._plan
+
+    def trapped_charge(self, pixel_signals):
+        """Calculate the charge captured by the serial traps from each pixel."""
+
+        pixel_signals = np.maximum(0, pixel_signals)
+        C = 0
+        for trap in self.traps:
+            C = C + trap.f(pixel_signals)
+
+        return np.asarray(C, dtype=np.result_type(pixel_signals, np.float32))
+
+def iterative_correction(imarr_dict, corrector_dict, max_workers=None, **kwargs):
+    """Apply iterative deferred charge correction to all amplifier images.
+
+    The amplifier images are corrected concurrently by a pool of worker threads,
+    each amplifier using its own corrector (see 
+    `DeferredChargeCorrector.iterative_correct`).
+
+    Args:
+        imarr_dict ('dict' of 'numpy.ndarray'): Image for each amplifier [e-].
+        corrector_dict ('dict' of 'DeferredChargeCorrector'): Corrector for 
+            each amplifier.
+        max_workers (int): Maximum number of worker threads.
+        **kwargs: Additional `DeferredChargeCorrector.iterative_correct` arguments.
+
+    Returns:
+        Tuple of dictionaries of corrected NumPy arrays and of convergence reports.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {amp : executor.submit(corrector_dict[amp].iterative_correct, 
+                                         imarr_dict[amp], **kwargs)
+                   for amp in imarr_dict}
+        results = {amp : future.result() for amp, future in futures.items()}
+
+    corrected_dict = {amp : result[0] for amp, result in results.items()}
+    report_dict = {amp : result[1] for amp, result in results.items()}
 
+    return corrected_dict, report_dict
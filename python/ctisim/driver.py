@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""Deferred charge fitting of many sensors.
+
+This submodule contains a driver that fits the deferred charge parameters of
+every amplifier of a set of sensors, such as a raft or the full focal plane,
+across a local process pool.  Completed work is checkpointed to disk so that
+an interrupted run resumes where it stopped.
+
+"""
+import os
+import json
+import uuid
+import warnings
+import numpy as np
+from os.path import join
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from astropy.io import fits
+
+from ctisim.core import SplineTrap
+from ctisim.fitting import fit_electronics, fit_global_cti, fit_trap_spline
+from ctisim.fitting import parameter_results_seed
+from ctisim.utils import ITL_AMP_GEOM, OverscanParameterResults, DeferredChargeCalibration
+
+class FitDriver:
+    """Parallel, resumable fitting of deferred charge calibrations.
+
+    Each amplifier is fit in three dependent stages (local offset, global CTI
+    and trapping function) as a separate task in a process pool.  Completed
+    stages are checkpointed per amplifier, and once every amplifier of a 
+    sensor is complete its parameter results and calibration files are 
+    written.  Sensors with a calibration file are skipped on a later run.
+    Given the results of an earlier run or a table of prior values, the fits
+    start from those values where they fit the data better (see `seed`).
+
+    Attributes:
+        overscan_files ('dict' of 'str'): Overscan results file of each sensor.
+        output_dirs ('dict' of 'str'): Output directory of each sensor.
+        amp_geom (AmplifierGeometry): Amplifier geometry information.
+        max_workers (int): Number of worker processes; the number of CPUs by default.
+        prior_results ('dict' of 'OverscanParameterResults'): Results of an 
+            earlier run for each sensor.
+        prior (dict): Prior value of each fit parameter, or None.
+        report (dict): Function evaluations of the fits of the last run, by 
+            seed (see `fit_report`).
+    """
+
+    stages = ['electronics', 'global_cti', 'trap']
+
+    def __init__(self, overscan_files, output_dir='.', amp_geom=ITL_AMP_GEOM,
+                 max_workers=None, prior_results=None, prior=None):
+
+        self.overscan_files = overscan_files
+        if isinstance(output_dir, dict):
+            self.output_dirs = output_dir
+        else:
+            self.output_dirs = {sensor_id : output_dir for sensor_id in overscan_files}
+        self.amp_geom = amp_geom
+        self.max_workers = max_workers
+        self.prior_results = prior_results if prior_results is not None else {}
+        self.prior = prior
+        self.report = {}
+
+    def calibration_file(self, sensor_id):
+        """Return the calibration file of a sensor."""
+
+        return join(self.output_dirs[sensor_id], '{0}_calibration.fits'.format(sensor_id))
+
+    def parameter_results_file(self, sensor_id):
+        """Return the overscan parameter results file of a sensor."""
+
+        return join(self.output_dirs[sensor_id],
+                    '{0}_parameter_results.fits'.format(sensor_id))
+
+    def checkpoint_file(self, sensor_id, amp):
+        """Return the checkpoint file of an amplifier."""
+
+        return join(self.output_dirs[sensor_id], '{0}_checkpoints'.format(sensor_id),
+                    'amp{0:02d}.json'.format(amp))
+
+    def seed(self, sensor_id, amp):
+        """Return the seed values of the fit parameters of an amplifier.
+
+        The seed values are taken from the earlier results for the amplifier,
+        where available, and otherwise from the prior values.
+
+        Args:
+            sensor_id (str): Sensor identifier.
+            amp (int): Amplifier number.
+
+        Returns:
+            Tuple of the dictionary of seed values, or None without either, and 
+            the name of its source, one of 'prior_results', 'prior' or 'default'.
+        """
+        if self.prior is None and sensor_id not in self.prior_results:
+            return None, 'default'
+
+        seed = {}
+        if self.prior is not None:
+            seed.update(self.prior)
+            source = 'prior'
+
+        if sensor_id in self.prior_results:
+            prior_seed = parameter_results_seed(self.prior_results[sensor_id], amp)
+            seed.update({name : value for name, value in prior_seed.items() 
+                         if value is not None})
+            source = 'prior_results'
+
+        return seed, source
+
+    def run(self):
+        """Fit every amplifier of every sensor that has no calibration file.
+
+        Failed amplifier tasks do not stop the remaining tasks; their sensors 
+        are completed on a later run.  The numbers of function evaluations of 
+        the fits of this run, but not those of stages read back from 
+        checkpoints, are summarized by starting values in `report`.
+
+        Returns:
+            Dictionary of the error message of each failed `(sensor_id, amp)` task.
+        """
+        checkpoints = {}
+        tasks = []
+        for sensor_id in self.overscan_files:
+            if os.path.exists(self.calibration_file(sensor_id)):
+                continue
+            os.makedirs(os.path.dirname(self.checkpoint_file(sensor_id, 1)), exist_ok=True)
+            checkpoints[sensor_id] = {}
+            for amp in range(1, 17):
+                checkpoint = read_checkpoint(self.checkpoint_file(sensor_id, amp))
+                if all(stage in checkpoint for stage in self.stages):
+                    checkpoints[sensor_id][amp] = checkpoint
+                else:
+                    tasks.append((sensor_id, amp))
+
+        ## Sensors with every amplifier already complete
+        for sensor_id in checkpoints:
+            if len(checkpoints[sensor_id]) == 16:
+                self.write_sensor(sensor_id, checkpoints[sensor_id])
+
+        failures = {}
+        self.report = {}
+        if len(tasks) == 0:
+            return failures
+
+        pending = deque(tasks)
+        max_workers = self.max_workers or os.cpu_count() or 1
+        futures = {}
+        completed = []
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while len(pending) > 0 or len(futures) > 0:
+                while len(pending) > 0 and len(futures) < max_workers:
+                    sensor_id, amp = pending.popleft()
+                    seed, source = self.seed(sensor_id, amp)
+                    future = executor.submit(fit_amplifier, self.overscan_files[sensor_id], 
+                                             amp, self.checkpoint_file(sensor_id, amp),
+                                             self.amp_geom, seed=seed, seed_source=source)
+                    futures[future] = (sensor_id, amp)
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sensor_id, amp = futures.pop(future)
+                    try:
+                        checkpoint, fitted_stages = future.result()
+                    except Exception as e:
+                        failures[(sensor_id, amp)] = str(e)
+                        continue
+                    checkpoints[sensor_id][amp] = checkpoint
+                    completed.append({stage : checkpoint[stage] for stage in fitted_stages})
+                    if len(checkpoints[sensor_id]) == 16:
+                        self.write_sensor(sensor_id, checkpoints[sensor_id])
+
+        self.report = fit_report(completed)
+
+        return failures
+
+    def write_sensor(self, sensor_id, checkpoints):
+        """Write the parameter results and calibration of a sensor from its checkpoints."""
+
+        cti_results = {amp : checkpoints[amp]['global_cti']['cti'] for amp in range(1, 17)}
+        drift_scales = {amp : checkpoints[amp]['electronics']['drift_scale']
+                        for amp in range(1, 17)}
+        decay_times = {amp : checkpoints[amp]['electronics']['decay_time']
+                       for amp in range(1, 17)}
+        param_results = OverscanParameterResults(sensor_id, cti_results,
+                                                 drift_scales, decay_times)
+        atomic_write(self.parameter_results_file(sensor_id),
+                     lambda outfile : param_results.write_fits(outfile, overwrite=True))
+
+        traps = {}
+        for amp in range(1, 17):
+            trap = checkpoints[amp]['trap']
+            traps[amp] = SplineTrap.from_table(trap['signals'], trap['trapped_charges'],
+                                               trap['emission_time'], trap['pixel'])
+        calibration = DeferredChargeCalibration.from_parameter_results(param_results, traps)
+        atomic_write(self.calibration_file(sensor_id),
+                     lambda outfile : calibration.write_fits(outfile, overwrite=True))
+
+def fit_amplifier(overscan_file, amp, checkpoint_file, amp_geom=ITL_AMP_GEOM, seed=None,
+                  seed_source='default'):
+    """Fit the remaining stages of an amplifier, checkpointing each completed stage.
+
+    The results of each fitted stage hold the fitted values of the varying 
+    parameters, the number of function evaluations and the source of the 
+    starting values.
+
+    Args:
+        overscan_file (str): Overscan results file of the sensor.
+        amp (int): Amplifier number.
+        checkpoint_file (str): Checkpoint file of the amplifier.
+        amp_geom (AmplifierGeometry): Amplifier geometry information.
+        seed (dict): Initial parameter values of the fits, or None to start 
+            from the fixed initial values.
+        seed_source (str): Source of the seed values, for reporting.
+
+    Returns:
+        Tuple of the dictionary of the results of each stage and the list of 
+        the stages fit by this call, rather than read from the checkpoint.
+    """
+    checkpoint = read_checkpoint(checkpoint_file)
+    fitted_stages = [stage for stage in FitDriver.stages if stage not in checkpoint]
+    num_transfers = amp_geom.nx + amp_geom.prescan_width
+    error = 7.0/np.sqrt(2000.)
+
+    with fits.open(overscan_file, memmap=True) as hdulist:
+        all_signals = np.array(hdulist[amp].data['FLATFIELD_SIGNAL'])
+        column_means = np.array(hdulist[amp].data['COLUMN_MEAN'])
+
+    ## Fit Local Electronic Offset Effect
+    if 'electronics' not in checkpoint:
+        start, stop = 3, 13
+        selection = all_signals < 150000.
+        result = fit_electronics(all_signals[selection],
+                                 column_means[selection, start:stop+1],
+                                 num_transfers, error, start=start, stop=stop, seed=seed)
+        if result.success:
+            drift_scale = result.params['driftscale'].value
+            decay_time = result.params['decaytime'].value
+        else:
+            warnings.warn("Electronics fitting failure: {0} Amp{1}".format(overscan_file, amp))
+            drift_scale = 0.0
+            decay_time = 2.4
+        checkpoint['electronics'] = {'drift_scale' : drift_scale, 'decay_time' : decay_time}
+        checkpoint['electronics'].update(stage_record(result, seed_source))
+        write_checkpoint(checkpoint_file, checkpoint)
+    drift_scale = checkpoint['electronics']['drift_scale']
+    decay_time = checkpoint['electronics']['decay_time']
+
+    ## Fit Global CTI
+    if 'global_cti' not in checkpoint:
+        start, stop = 1, 2
+        selection = all_signals < 10000.
+        result = fit_global_cti(all_signals[selection],
+                                column_means[selection, start:stop+1],
+                                num_transfers, error, drift_scale, decay_time, amp_geom,
+                                start=start, stop=stop, seed=seed)
+        checkpoint['global_cti'] = {'cti' : 10**result.params['ctiexp'].value}
+        checkpoint['global_cti'].update(stage_record(result, seed_source))
+        write_checkpoint(checkpoint_file, checkpoint)
+    cti = checkpoint['global_cti']['cti']
+
+    ## Determine Localized Trapping
+    if 'trap' not in checkpoint:
+        start, stop = 1, 20
+        selection = all_signals < 150000.
+        trap = fit_trap_spline(all_signals[selection], column_means[selection, start:stop+1],
+                               column_means[selection, 0], cti, drift_scale, decay_time,
+                               num_transfers, start=start, stop=stop)
+        signals, trapped_charges = trap.table()
+        checkpoint['trap'] = {'signals' : signals.tolist(),
+                              'trapped_charges' : trapped_charges.tolist(),
+                              'emission_time' : trap.emission_time, 'pixel' : trap.pixel}
+        write_checkpoint(checkpoint_file, checkpoint)
+
+    return checkpoint, fitted_stages
+
+def stage_record(result, seed_source):
+    """Return the checkpoint record of a fit result.
+
+    The source of the starting values is `seed_source` if the fit started from
+    the seed values, and otherwise 'default' (see `select_seed`).  The number
+    of function evaluations includes the model evaluations used to choose 
+    between them.
+    """
+    seed = seed_source if result.seeded else 'default'
+    record = {'success' : bool(result.success), 
+              'nfev' : int(result.nfev) + int(result.seed_nfev), 
+              'chisqr' : float(result.chisqr), 'seed' : seed}
+
+    return record
+
+def fit_report(checkpoints):
+    """Summarize the number of function evaluations of fits by source of seed values.
+
+    Args:
+        checkpoints ('list' of 'dict'): Stage results of amplifiers.
+
+    Returns:
+        Dictionary of the number of fits and mean number of function evaluations
+        for each seed source, for each fit stage.
+    """
+    nfevs = {}
+    for checkpoint in checkpoints:
+        for stage, record in checkpoint.items():
+            if 'nfev' in record and 'seed' in record:
+                nfevs.setdefault(stage, {}).setdefault(record['seed'], []).append(record['nfev'])
+
+    report = {stage : {source : (len(values), float(np.mean(values))) 
+                       for source, values in sorted(nfevs[stage].items())}
+              for stage in nfevs}
+
+    return report
+
+def format_fit_report(report):
+    """Return the lines of a summary of function evaluations by seed (see `fit_report`).
+
+    The mean number of function evaluations of seeded fits is compared with 
+    that of fits from the default initial values of the same stage, if any.
+    Fits whose seed values were rejected (see `stage_record`) count as fits 
+    from the default initial values.
+    """
+    lines = []
+    for stage in report:
+        default_nfev = report[stage].get('default', (0, None))[1]
+        for source, (num_fits, mean_nfev) in report[stage].items():
+            line = "Stage {0}: {1} fits started from {2} values, mean of {3:.1f} function evaluations"
+            line = line.format(stage, num_fits, source, mean_nfev)
+            if default_nfev is not None and source != 'default':
+                line += " ({0:+.0%} relative to default values)".format(mean_nfev/default_nfev - 1)
+            lines.append(line)
+
+    return lines
+
+def run_summary(driver, failures):
+    """Return the lines of a summary of a fit driver run.
+
+    The summary lists the failed amplifier tasks, the completed sensors and
+    the function evaluations of the fits (see `format_fit_report`), for the
+    fitting scripts to print.
+
+    Args:
+        driver (FitDriver): Fit driver, after its `run`.
+        failures (dict): Error message of each failed `(sensor_id, amp)` task,
+            as returned by `FitDriver.run`.
+
+    Returns:
+        List of str.
+    """
+    lines = []
+    for (sensor_id, amp), message in sorted(failures.items()):
+        lines.append("Error occurred for {0} Amp{1}!".format(sensor_id, amp))
+        lines.append(message)
+    for sensor_id in driver.overscan_files:
+        if os.path.exists(driver.calibration_file(sensor_id)):
+            lines.append("Completed sensor {0}".format(sensor_id))
+    lines.extend(format_fit_report(driver.report))
+    if len(failures) > 0:
+        lines.append("{0} amplifier fits failed; rerun to retry them.".format(len(failures)))
+
+    return lines
+
+def read_checkpoint(checkpoint_file):
+    """Read the stage results of a checkpoint file, or an empty dictionary if none."""
+
+    try:
+        with open(checkpoint_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    """Write the stage results of a checkpoint file atomically."""
+
+    def write(outfile):
+        with open(outfile, 'w') as f:
+            json.dump(checkpoint, f)
+
+    atomic_write(checkpoint_file, write)
+
+def atomic_write(outfile, write):
+    """Write a file atomically.
+
+    The file is written by `write` to a temporary file in the same directory,
+    which then replaces `outfile`, so `outfile` is either absent, unchanged or
+    complete.  The temporary file is created under a unique name with the 
+    permissions of any new file, as set by the process umask.
+
+    Args:
+        outfile (str): Output file.
+        write (callable): Function writing a file of a given name.
+    """
+    directory, name = os.path.split(os.path.abspath(outfile))
+    tmpfile = join(directory, '.{0}.{1}.tmp'.format(name, uuid.uuid4().hex))
+    fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    os.close(fd)
+    try:
+        write(tmpfile)
+        os.replace(tmpfile, outfile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
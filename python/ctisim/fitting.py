@@ -7,20 +7,26 @@ due to a variety of different simplified deferred charge models.
 ToDo:
 
 """
+import copy
 import numpy as np
-from ctisim import SegmentSimulator
-from ctisim import LinearTrap, LogisticTrap
+from lmfit import Minimizer, Parameters
+from ctisim.image import ReadoutPlan, stack_readout_components
+from ctisim import LinearTrap, LogisticTrap, SplineTrap
 from ctisim import BaseOutputAmplifier, FloatingOutputAmplifier
 
 class OverscanModel:
     """Base object handling model/data fit comparisons."""
 
+    def evaluate(self, params, signals, *args, **kwargs):
+        """Calculate model results with this model; by default `model_results`."""
+
+        return self.model_results(params, signals, *args, **kwargs)
+
     def loglikelihood(self, params, signals, data, error, 
                       *args, **kwargs):
         """Calculate log likelihood of the model."""
 
-        model_results = self.model_results(params, signals, 
-                                           *args, **kwargs)
+        model_results = self.evaluate(params, signals, *args, **kwargs)
 
         inv_sigma2 = 1./(error**2.)
         diff = model_results-data
@@ -34,12 +40,30 @@ class OverscanModel:
         ll = self.loglikelihood(params, signals, data, error, *args, **kwargs)
 
         return -ll
-        
+
+    def batch_loglikelihood(self, theta, params, signals, data, error,
+                            *args, **kwargs):
+        """Calculate log likelihood of the model for a batch of parameter vectors.
+
+        Each row of `theta` holds values for the varying parameters of `params`,
+        in order, making this suitable as a vectorized `emcee` log probability.
+        """
+        names = varying_parameter_names(params)
+        v = params.valuesdict()
+        param_sets = [dict(v, **dict(zip(names, row))) for row in np.atleast_2d(theta)]
+
+        model_results = self.batch_model_results(param_sets, signals, 
+                                                 *args, **kwargs)
+
+        inv_sigma2 = 1./(error**2.)
+        diff = model_results-data
+
+        return -0.5*(np.sum(inv_sigma2*(diff)**2., axis=(-2, -1)))
 
     def rms_error(self, params, signals, data, error, *args, **kwargs):
         """Calculate RMS error between model and data."""
 
-        model_results = self.model_results(params, signals, *args, **kwargs)
+        model_results = self.evaluate(params, signals, *args, **kwargs)
 
         inv_sigma2 = 1./(error**2.)
         diff = model_pixels-data
@@ -51,47 +75,321 @@ class OverscanModel:
     def difference(self, params, signals, data, error, *args, **kwargs):
         """Calculate the flattened difference array between model and data."""
 
-        model_results = self.model_results(params, signals, *args, **kwargs)
+        model_results = self.evaluate(params, signals, *args, **kwargs)
 
         inv_sigma2 = 1./(error**2.)
         diff = (model_results-data).flatten()
 
         return diff
+
+    def jacobian(self, params, signals, data, error, *args, **kwargs):
+        """Calculate the Jacobian of the difference array by finite differences.
+
+        The model and every parameter variation are evaluated together in a single 
+        call to `batch_model_results`.  The result has one column per varying 
+        parameter, for use as the `Dfun` argument of `lmfit.Minimizer.minimize`.
+        """
+        names = varying_parameter_names(params)
+        v = params.valuesdict()
+
+        param_sets = [v]
+        steps = np.zeros(len(names))
+        for i, name in enumerate(names):
+            step = np.sqrt(np.finfo(np.float64).eps)*max(abs(v[name]), 1.)
+            if v[name] + step > params[name].max:
+                step = -step
+            param_sets.append(dict(v, **{name : v[name] + step}))
+            steps[i] = step
+
+        model_results = self.batch_model_results(param_sets, signals, 
+                                                 *args, **kwargs)
+        jac = (model_results[1:] - model_results[0]).reshape(len(names), -1)/steps[:, None]
+
+        return jac.T
+
+    def batch_model_results(self, param_sets, signals, *args, **kwargs):
+        """Calculate model results for a sequence of parameter sets."""
+
+        model_results = np.asarray([self.evaluate(params, signals, *args, **kwargs) 
+                                    for params in param_sets])
+
+        return model_results
     
 class SimpleModel(OverscanModel):
     """Simple analytic overscan model."""
         
     @staticmethod
     def model_results(params, signals, num_transfers, start=1, stop=10):
-        
-        v = params.valuesdict()        
+        """Calculate the overscan pixel values for each signal.
+
+        All signals are evaluated at once.  If the parameter values are 1-D arrays,
+        such as from a dictionary of stacked parameter vectors, every parameter 
+        vector is evaluated in the same call and the result has shape 
+        `(nparams, nsignals, nx)`; otherwise it has shape `(nsignals, nx)`.
+        """
+        v = valuesdict(params)
         try:
-            v['cti'] = 10**v['ctiexp']
+            v['cti'] = 10**np.asarray(v['ctiexp'], dtype=np.float64)
         except KeyError:
             pass
+
+        ## Parameter vectors broadcast along a leading axis
+        p = {name : np.asarray(v[name], dtype=np.float64)[..., None, None] 
+             for name in ['trapsize', 'scaling', 'emissiontime', 'cti', 
+                          'driftscale', 'decaytime']}
         
         x = np.arange(start, stop+1)
-        res = np.zeros((signals.shape[0], x.shape[0]))
+        s = np.asarray(signals, dtype=np.float64)[:, None]
 
-        for i, s in enumerate(signals):
-            res[i, :] = (np.minimum(v['trapsize'], s*v['scaling'])*(np.exp(1/v['emissiontime'])-1.)*np.exp(-x/v['emissiontime'])
-                         + s*num_transfers*v['cti']**x
-                         + v['driftscale']*s*np.exp(-x/float(v['decaytime'])))
+        res = (np.minimum(p['trapsize'], s*p['scaling'])*(np.exp(1/p['emissiontime'])-1.)*np.exp(-x/p['emissiontime'])
+               + s*num_transfers*p['cti']**x
+               + p['driftscale']*s*np.exp(-x/p['decaytime']))
                                             
         return res
+
+    def jacobian(self, params, signals, data, error, num_transfers, start=1, stop=10):
+        """Calculate the Jacobian of the difference array analytically.
+
+        The result has one column per varying parameter, in the order used by
+        `lmfit`, for use as the `Dfun` argument of `lmfit.Minimizer.minimize`.
+        At the saturation of the trap term the derivative is taken with respect 
+        to `trapsize` if the trap is saturated, and `scaling` otherwise.
+
+        Raises:
+            ValueError: If a varying parameter is not a model parameter.
+        """
+        names = varying_parameter_names(params)
+        v = valuesdict(params)
+        if 'ctiexp' in v:
+            v['cti'] = 10**v['ctiexp']
+
+        x = np.arange(start, stop+1)
+        s = np.asarray(signals, dtype=np.float64)[:, None]
+
+        ## Trap term
+        tau = v['emissiontime']
+        saturated = v['trapsize'] < s*v['scaling']
+        emission = (np.exp(1/tau)-1.)*np.exp(-x/tau)
+        d_emission = ((x-1)*np.exp((1-x)/tau) - x*np.exp(-x/tau))/tau**2
+
+        ## CTI term
+        cti_term = s*num_transfers*v['cti']**x
+
+        ## Drift term
+        decay = np.exp(-x/v['decaytime'])
+
+        derivatives = {}
+        for name in names:
+            if name == 'trapsize':
+                derivative = np.where(saturated, emission, 0.)
+            elif name == 'scaling':
+                derivative = np.where(saturated, 0., s*emission)
+            elif name == 'emissiontime':
+                derivative = np.minimum(v['trapsize'], s*v['scaling'])*d_emission
+            elif name == 'ctiexp':
+                derivative = cti_term*x*np.log(10.)
+            elif name == 'cti':
+                derivative = cti_term*x/v['cti']
+            elif name == 'driftscale':
+                derivative = s*decay
+            elif name == 'decaytime':
+                derivative = v['driftscale']*s*decay*x/v['decaytime']**2
+            else:
+                raise ValueError('{0} is not a SimpleModel parameter.'.format(name))
+            derivatives[name] = np.broadcast_to(derivative, (s.shape[0], x.shape[0]))
+
+        jac = np.stack([derivatives[name].ravel() for name in names], axis=1)
+
+        return jac
+
+    def batch_model_results(self, param_sets, signals, *args, **kwargs):
+        """Calculate model results for a sequence of parameter sets.
+
+        The parameter sets are stacked into parameter vectors and evaluated 
+        together in a single call to `model_results`.
+        """
+        values = [valuesdict(params) for params in param_sets]
+        stacked_params = {name : np.asarray([v[name] for v in values]) for name in values[0]}
+
+        return self.model_results(stacked_params, signals, *args, **kwargs)
     
 class SimulatedModel(OverscanModel):
-    """Simulated overscan model."""
-        
+    """Simulated overscan model.
+
+    The model holds a `ReadoutPlan`, so the readout work buffers are reused 
+    between the model evaluations of a fit (see `evaluate`); calling
+    `model_results` on the class creates a new plan on each call.  A model
+    must not be evaluated from more than one thread at a time.
+    """
+
+    def __init__(self):
+
+        self._plan = None
+
     @staticmethod
     def model_results(params, signals, num_transfers, amp_geom, **kwargs):
+        """Calculate model results with a new model (see `evaluate`)."""
+
+        return SimulatedModel().evaluate(params, signals, num_transfers, amp_geom, **kwargs)
+        
+    def evaluate(self, params, signals, num_transfers, amp_geom, **kwargs):
+        """Calculate model results, reusing the readout plan of the model."""
         
-        v = params.valuesdict() 
+        v = valuesdict(params)
         
         start = kwargs.pop('start', 1)
         stop = kwargs.pop('stop', 10)
         trap_type = kwargs.pop('trap_type', None)
+        fixed_traps = kwargs.pop('fixed_traps', None)
+
+        cti, traps, output_amplifier = self.readout_components(v, trap_type, fixed_traps)
+
+        ## Simulate ramp readout, up to the last overscan pixel
+        model_results = self.ramp_readout(signals, amp_geom, cti, traps, output_amplifier,
+                                          stop, **kwargs)
+
+        return model_results[:, start-stop-1:]
+
+    def batch_model_results(self, param_sets, signals, num_transfers, amp_geom, **kwargs):
+        """Calculate model results for a sequence of parameter sets.
+
+        All parameter sets are simulated together in a single vectorized readout,
+        with the serial traps and output amplifiers stacked along a batch axis
+        (see `SegmentSimulator.batch_readout`).
+        """
+
+        start = kwargs.pop('start', 1)
+        stop = kwargs.pop('stop', 10)
+        trap_type = kwargs.pop('trap_type', None)
+        fixed_traps = kwargs.pop('fixed_traps', None)
+
+        components = [self.readout_components(valuesdict(params), trap_type, fixed_traps) 
+                      for params in param_sets]
+        ctis, traps, output_amplifiers = zip(*components)
+        if traps[0] is None:
+            traps = None
+        ctis, traps, output_amplifier = stack_readout_components(ctis, traps, 
+                                                                 output_amplifiers)
+
+        ## Simulate ramp readout, up to the last overscan pixel
+        model_results = self.ramp_readout(signals, amp_geom, ctis, traps, output_amplifier,
+                                          stop, **kwargs)
+
+        return model_results[:, :, start-stop-1:]
+
+    def jacobian(self, params, signals, data, error, num_transfers, amp_geom, **kwargs):
+        """Calculate the Jacobian of the difference array by forward differentiation.
+
+        The derivatives of the model with respect to every varying parameter are
+        propagated through a single simulated readout (see the `tangents` keyword
+        of `SegmentSimulator.readout`).  The result has one column per varying
+        parameter, in the order used by `lmfit`, for use as the `Dfun` argument
+        of `lmfit.Minimizer.minimize`.
+
+        Raises:
+            ValueError: If a varying parameter is not a model parameter.
+        """
+        names = varying_parameter_names(params)
+        v = valuesdict(params)
+
+        start = kwargs.pop('start', 1)
+        stop = kwargs.pop('stop', 10)
+        trap_type = kwargs.pop('trap_type', None)
+        fixed_traps = kwargs.pop('fixed_traps', None)
+
+        cti, traps, output_amplifier = self.readout_components(v, trap_type, fixed_traps)
+
+        ## Simulate ramp readout with derivatives, up to the last overscan pixel
+        _, tangents = self.ramp_readout(signals, amp_geom, cti, traps, output_amplifier,
+                                        stop, tangents=True, **kwargs)
+
+        ## Readout derivative of each model parameter; the fitted trap is last
+        if fixed_traps is None:
+            trap_index = 0
+        else:
+            trap_index = len(fixed_traps) if isinstance(fixed_traps, list) else 1
+        tangent_keys = {'ctiexp' : 'cti', 'cti' : 'cti',
+                        'driftscale' : 'scale', 'decaytime' : 'decay_time',
+                        'trapsize' : 'trap{0}_size', 'emissiontime' : 'trap{0}_emission_time',
+                        'scaling' : 'trap{0}_scaling', 'f0' : 'trap{0}_f0', 'k' : 'trap{0}_k'}
+
+        columns = []
+        for name in names:
+            try:
+                key = tangent_keys[name].format(trap_index)
+            except KeyError:
+                raise ValueError('{0} is not a SimulatedModel parameter.'.format(name))
+            try:
+                column = tangents[key][:, start-stop-1:].flatten()
+            except KeyError:
+                column = np.zeros(signals.shape[0]*(stop-start+1))
+            if name == 'ctiexp':
+                column *= cti*np.log(10.)
+            columns.append(column)
+
+        jac = np.stack(columns, axis=1)
+
+        return jac
+
+    def reduced_model_error(self, params, signals, num_transfers, amp_geom,
+                            reduced_pixels, **kwargs):
+        """Calculate the maximum difference of the reduced model from the full model.
+
+        The reduced model simulates only the last `reduced_pixels` pixels of the 
+        serial register, with the preceding transfers folded in as proportional
+        loss (see `SegmentSimulator.readout`).
+        """
+        kwargs.pop('reduced_pixels', None)
+        full_results = self.evaluate(params, signals, num_transfers, amp_geom, 
+                                     **dict(kwargs))
+        reduced_results = self.evaluate(params, signals, num_transfers, amp_geom, 
+                                        reduced_pixels=reduced_pixels, **kwargs)
+
+        return np.max(np.abs(reduced_results-full_results))
+
+    def ramp_readout(self, signals, amp_geom, cti, traps, output_amplifier, 
+                     serial_overscan_width, **kwargs):
+        """Simulate the readout of a flat field ramp image with the readout plan of the model.
+
+        The plan is updated to the given CTI, output amplifier and copies of 
+        the serial traps, which may be stacked for a batch of readouts.  The 
+        keyword toggles and options are those of `SegmentSimulator.readout`;
+        the model output amplifiers have no read noise, so none is drawn.
+
+        Args:
+            signals (numpy.ndarray): Flat field signal of each row [e-].
+            amp_geom (AmplifierGeometry): Amplifier geometry information.
+            cti (float or numpy.ndarray): Proportional loss per pixel transfer.
+            traps ('list' of 'SerialTrap'): Serial traps, or None.
+            output_amplifier (BaseOutputAmplifier): Output amplifier.
+            serial_overscan_width (int): Number of serial overscan pixels.
+
+        Returns:
+            NumPy array.
+        """
+        if traps is not None:
+            if not isinstance(traps, list):
+                traps = [traps]
+            traps = [copy.copy(trap) for trap in traps]
+
+        if self._plan is None:
+            self._plan = ReadoutPlan(cti, output_amplifier, traps=traps,
+                                     serial_overscan_width=serial_overscan_width)
+        else:
+            self._plan.update(cti, output_amplifier, traps=traps)
+            self._plan.serial_overscan_width = serial_overscan_width
         
+        prescan_width = amp_geom.prescan_width
+        segarr = self._plan.buffer('ramp', (signals.shape[0], amp_geom.nx+prescan_width))
+        segarr[:, :prescan_width] = 0.0
+        segarr[:, prescan_width:] = np.reshape(signals, (-1, 1))
+
+        return self._plan.execute(segarr, no_noise=True, **kwargs)
+
+    @staticmethod
+    def readout_components(v, trap_type=None, fixed_traps=None):
+        """Create the CTI, serial traps and output amplifier for a parameter set."""
+
         ## Electronics effect optimization
         try:
             output_amplifier = FloatingOutputAmplifier(1.0, 
@@ -119,23 +417,266 @@ class SimulatedModel(OverscanModel):
             raise ValueError('Trap type must be linear or logistic or None')
             
         ## Optional fixed traps
-        try:
-            fixed_traps = kwargs['fixed_traps']
-            if isinstance(traps, list):
-                traps.append(trap)
-            else:
-                traps = [fixed_traps, trap]
-        except KeyError:
+        if fixed_traps is None:
             traps = trap
+        else:
+            if not isinstance(fixed_traps, list):
+                fixed_traps = [fixed_traps]
+            traps = fixed_traps + ([trap] if trap is not None else [])
 
-        ## Simulate ramp readout
-        imarr = np.zeros((signals.shape[0], amp_geom.nx))
-        ramp = SegmentSimulator(imarr, amp_geom.prescan_width, output_amplifier,
-                                cti=v['cti'], traps=trap)
-        ramp.ramp_exp(signals)
-        model_results = ramp.readout(serial_overscan_width=amp_geom.serial_overscan_width,
-                                     parallel_overscan_width=0, **kwargs)
-        
-        ncols = amp_geom.prescan_width + amp_geom.nx
+        return v['cti'], traps, output_amplifier
+
+def fit_electronics(signals, data, num_transfers, error, start=3, stop=13, seed=None):
+    """Fit the local offset drift scale and decay time of an amplifier.
+
+    The `SimpleModel` is fit to the overscan pixels `start` to `stop` of flat
+    field ramp data, with the CTI and trapping parameters fixed.  The fit may
+    be warm-started from the seed values of the varying parameters (see 
+    `select_seed`).
+
+    Args:
+        signals (numpy.ndarray): Flat field signal of each row [e-].
+        data (numpy.ndarray): Overscan pixel values `start` to `stop` of each row.
+        num_transfers (int): Number of serial transfers.
+        error (float): Error of the overscan pixel values.
+        start (int): First overscan pixel.
+        stop (int): Last overscan pixel.
+        seed (dict): Initial parameter values, such as from `parameter_results_seed`.
+
+    Returns:
+        lmfit.MinimizerResult, with the attributes `seeded`, True if the fit 
+        started from the seed values, and `seed_nfev`, the number of model 
+        evaluations used to choose the starting values.
+    """
+    params = Parameters()
+    params.add('ctiexp', value=-6, min=-7, max=-5, vary=False)
+    params.add('trapsize', value=0.0, min=0., max=10., vary=False)
+    params.add('scaling', value=0.08, min=0, max=1.0, vary=False)
+    params.add('emissiontime', value=0.4, min=0.1, max=1.0, vary=False)
+    params.add('driftscale', value=0.00022, min=0., max=0.001)
+    params.add('decaytime', value=2.4, min=0.1, max=4.0)
+
+    model = SimpleModel()
+    fcn_args = (signals, data, error, num_transfers)
+    fcn_kws = {'start' : start, 'stop' : stop}
+    seeded, seed_nfev = False, 0
+    if seed is not None:
+        params, seeded, seed_nfev = select_seed(model, params, seed, *fcn_args, **fcn_kws)
+
+    minner = Minimizer(model.difference, params, fcn_args=fcn_args, fcn_kws=fcn_kws)
+    result = minner.minimize(Dfun=model.jacobian)
+    result.seeded = seeded
+    result.seed_nfev = seed_nfev
+
+    return result
+
+def fit_global_cti(signals, data, num_transfers, error, drift_scale, decay_time, 
+                   amp_geom, start=1, stop=2, reduced_pixels=32, seed=None):
+    """Fit the global CTI of an amplifier.
+
+    The `SimulatedModel` is fit to the first overscan pixels of low signal flat 
+    field ramp data, with the local offset fixed.  A linear serial trap is 
+    fit together with the CTI if the overscan signal indicates trapping, and 
+    the reduced readout is used if it agrees with the full readout.  The fit
+    may be warm-started from the seed values of the varying parameters (see 
+    `select_seed`).
+
+    Args:
+        signals (numpy.ndarray): Flat field signal of each row [e-].
+        data (numpy.ndarray): Overscan pixel values `start` to `stop` of each row.
+        num_transfers (int): Number of serial transfers.
+        error (float): Error of the overscan pixel values.
+        drift_scale (float): Local offset drift scale.
+        decay_time (float): Local offset decay time.
+        amp_geom (AmplifierGeometry): Amplifier geometry information.
+        start (int): First overscan pixel.
+        stop (int): Last overscan pixel.
+        reduced_pixels (int): Number of register pixels of the reduced readout.
+        seed (dict): Initial parameter values, such as from `parameter_results_seed`.
+
+    Returns:
+        lmfit.MinimizerResult, with the attributes `seeded` and `seed_nfev` 
+        (see `fit_electronics`).
+    """
+    ## CTI test
+    test = (data[:, 0]+data[:, 1])/(num_transfers*signals)
+    do_trapping = np.median(test) > 5.E-6
+
+    params = Parameters()
+    params.add('ctiexp', value=-6, min=-7, max=-5, vary=True)
+    if do_trapping:
+        params.add('trapsize', value=5.0, min=0., max=30., vary=True)
+        params.add('scaling', value=0.08, min=0, max=1.0, vary=True)
+        params.add('emissiontime', value=0.35, min=0.1, max=1.0, vary=True)
+    else:
+        params.add('trapsize', value=0.0, min=0., max=10., vary=False)
+        params.add('scaling', value=0.08, min=0, max=1.0, vary=False)
+        params.add('emissiontime', value=0.35, min=0.1, max=1.0, vary=False)
+    params.add('driftscale', value=drift_scale, min=0., max=0.001, vary=False)
+    params.add('decaytime', value=decay_time, min=0.1, max=4.0, vary=False)
+
+    model = SimulatedModel()
+    fcn_kws = {'start' : start, 'stop' : stop, 'trap_type' : 'linear'}
+    seeded, seed_nfev = False, 0
+    if seed is not None:
+        params, seeded, seed_nfev = select_seed(model, params, seed, signals, data, error,
+                                                num_transfers, amp_geom, **fcn_kws)
+
+    ## Use reduced model if it agrees with full simulation
+    reduced_error = model.reduced_model_error(params, signals, num_transfers, amp_geom,
+                                              reduced_pixels, **fcn_kws)
+    if reduced_error < 0.01*error:
+        fcn_kws['reduced_pixels'] = reduced_pixels
+
+    minner = Minimizer(model.difference, params, 
+                       fcn_args=(signals, data, error, num_transfers, amp_geom),
+                       fcn_kws=fcn_kws)
+    result = minner.minimize(Dfun=model.jacobian)
+    result.seeded = seeded
+    result.seed_nfev = seed_nfev
+
+    return result
+
+def fit_trap_spline(signals, data, last_pixel_signals, cti, drift_scale, decay_time,
+                    num_transfers, start=1, stop=20, emission_time=0.4, pixel=1):
+    """Determine the trapping function of an amplifier as a spline trap.
+
+    The trapped charge at each signal is the sum of the first three overscan
+    pixels in excess of the `SimpleModel` for the CTI and local offset alone.
+    
+    Args:
+        signals (numpy.ndarray): Flat field signal of each row [e-].
+        data (numpy.ndarray): Overscan pixel values `start` to `stop` of each row.
+        last_pixel_signals (numpy.ndarray): Last image pixel value of each row.
+        cti (float): Global CTI.
+        drift_scale (float): Local offset drift scale.
+        decay_time (float): Local offset decay time.
+        num_transfers (int): Number of serial transfers.
+        start (int): First overscan pixel.
+        stop (int): Last overscan pixel.
+        emission_time (float): Trap emission time constant [1/transfers].
+        pixel (int): Serial pixel location of trap.
+
+    Returns:
+        SplineTrap.
+    """
+    params = {'ctiexp' : np.log10(cti), 'trapsize' : 0.0, 'scaling' : 0.08, 
+              'emissiontime' : 0.35, 'driftscale' : drift_scale, 'decaytime' : decay_time}
+    model = SimpleModel.model_results(params, signals, num_transfers, 
+                                      start=start, stop=stop)
+
+    res = np.sum((data-model)[:, :3], axis=1)
+    x = np.asarray(last_pixel_signals - drift_scale*last_pixel_signals, dtype=np.float64)
+    y = np.maximum(0, res)
+
+    # Pad left with ramp
+    y = np.pad(y, (10, 0), 'linear_ramp', end_values=(0, 0))
+    x = np.pad(x, (10, 0), 'linear_ramp', end_values=(0, 0))
+
+    # Pad right with constant
+    y = np.pad(y, (1, 1), 'constant', constant_values=(0, y[-1]))
+    x = np.pad(x, (1, 1), 'constant', constant_values=(-1, 200000.))
+
+    return SplineTrap.from_table(x, y, emission_time, pixel)
+
+def seed_parameters(params, seed, margin=1e-3):
+    """Set the initial values of the varying parameters from seed values.
+
+    Fixed parameters, and parameters without a finite seed value, are unchanged.
+    Seed values are kept inside the parameter bounds by a fraction `margin` of
+    the parameter range, as a parameter that starts at a bound may not move 
+    from it.
+
+    Args:
+        params (lmfit.Parameters): Fit parameters, updated in place.
+        seed (dict): Seed value of each parameter.
+        margin (float): Fraction of the parameter range kept from the bounds.
+
+    Returns:
+        Number of parameters set from seed values.
+    """
+    num_seeded = 0
+    for name in varying_parameter_names(params):
+        value = seed.get(name, None)
+        if value is None or not np.isfinite(value):
+            continue
+        par = params[name]
+        width = margin*(par.max - par.min)
+        if np.isfinite(width):
+            value = min(max(value, par.min + width), par.max - width)
+        par.set(value=value)
+        num_seeded += 1
+
+    return num_seeded
+
+def select_seed(model, params, seed, signals, data, error, *args, **kwargs):
+    """Return the fit parameters starting from seed values, if they fit the data better.
+
+    A fit that starts from seed values can converge to a different local
+    minimum than one that starts from the initial values.  The fit starts from
+    whichever of the seeded and initial values has the smaller sum of squared
+    differences between model and data, at the cost of two model evaluations.
+    If the seed leaves the varying parameters at their initial values, these
+    are used without evaluating the model.
+
+    Args:
+        model (OverscanModel): Overscan model.
+        params (lmfit.Parameters): Fit parameters at their initial values.
+        seed (dict): Seed value of each parameter (see `seed_parameters`).
+        signals (numpy.ndarray): Flat field signal of each row [e-].
+        data (numpy.ndarray): Overscan pixel values of each row.
+        error (float): Error of the overscan pixel values.
+
+    Returns:
+        Tuple of the lmfit.Parameters, whether they hold the seed values, and
+        the number of model evaluations used.
+    """
+    seeded_params = params.copy()
+    num_seeded = seed_parameters(seeded_params, seed)
+    if num_seeded == 0 or all(seeded_params[name].value == params[name].value 
+                              for name in varying_parameter_names(params)):
+        return params, False, 0
+
+    cost = np.sum(np.square(model.difference(params, signals, data, error, 
+                                             *args, **kwargs)))
+    seeded_cost = np.sum(np.square(model.difference(seeded_params, signals, data, error,
+                                                    *args, **kwargs)))
+
+    if seeded_cost <= cost:
+        return seeded_params, True, 2
+    else:
+        return params, False, 2
+
+def parameter_results_seed(parameter_results, ampnum):
+    """Return the seed values of the fit parameters of an amplifier from overscan parameter results.
+
+    Args:
+        parameter_results (OverscanParameterResults): Results of an earlier fit.
+        ampnum (int): Amplifier number.
+
+    Returns:
+        Dictionary of parameter values.
+    """
+    cti = parameter_results.cti_results[ampnum]
+    seed = {'ctiexp' : np.log10(cti) if cti > 0 else None,
+            'driftscale' : parameter_results.drift_scales[ampnum],
+            'decaytime' : parameter_results.decay_times[ampnum]}
+
+    return seed
+
+def valuesdict(params):
+    """Return an ordered dictionary of parameter values."""
+
+    try:
+        v = params.valuesdict()
+    except AttributeError:
+        v = dict(params)
+
+    return v
+
+def varying_parameter_names(params):
+    """Return names of the varying parameters, in the order used by `lmfit`."""
+
+    names = [name for name, par in params.items() if par.vary and par.expr is None]
 
-        return model_results[:, ncols+start-1:ncols+stop]
+    return names
@@ -16,16 +16,21 @@ import galsim
 import warnings
 import copy
 import numpy as np
+import hashlib
+import threading
 import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from astropy.io import fits
+from scipy.stats import binom
 
-from ctisim.core import FloatingOutputAmplifier, SerialTrap
+from ctisim.core import BaseOutputAmplifier, FloatingOutputAmplifier, SerialTrap
 from lsst.eotest.sensor.MaskedCCD import MaskedCCD
 
 class ImageSimulator:
 
     def __init__(self, ny, nx, prescan_width, serial_overscan_width, 
-                 parallel_overscan_width, segments):
+                 parallel_overscan_width, segments, random_seed=None):
 
         ## Verify and assign segments and geometry
         for i in range(1, 17):
@@ -40,9 +45,13 @@ class ImageSimulator:
         self.serial_overscan_width = serial_overscan_width
         self.parallel_overscan_width = parallel_overscan_width
 
+        ## Root of the independent random number streams
+        self.seed_sequence = np.random.SeedSequence(random_seed)
+
     @classmethod
     def from_image_fits(cls, infile, output_amplifiers, bias_frame=None,
-                        linearity_correction=None, cti=None, traps=None):
+                        linearity_correction=None, cti=None, traps=None,
+                        random_seed=None, dtype=np.float64):
         """Initialize from existing FITs file."""
 
         ## Geometry information from infile
@@ -67,16 +76,16 @@ class ImageSimulator:
 
             imarr = ccd.unbiased_and_trimmed_image(i).getImage().getArray()*gain
             segments[i] = SegmentSimulator(imarr, prescan_width, output_amplifier, 
-                                           cti=cti[i], traps=traps[i])
+                                           cti=cti[i], traps=traps[i], dtype=dtype)
 
         image = cls(ny, nx, prescan_width, serial_overscan_width, 
-                    parallel_overscan_width, segments)
+                    parallel_overscan_width, segments, random_seed=random_seed)
 
         return image
 
     @classmethod
     def from_amp_geom(cls, amp_geom, output_amplifiers, cti=None,
-                      traps=None):
+                      traps=None, random_seed=None, dtype=np.float64):
 
         ny = amp_geom.ny
         nx = amp_geom.nx
@@ -95,10 +104,11 @@ class ImageSimulator:
             output_amplifier = output_amplifiers[i]
 
             segments[i] =  SegmentSimulator.from_amp_geom(amp_geom, output_amplifier, 
-                                                          cti=cti[i], traps=traps[i])
+                                                          cti=cti[i], traps=traps[i],
+                                                          dtype=dtype)
 
         image = cls(ny, nx, prescan_width, serial_overscan_width, 
-                    parallel_overscan_width, segments)
+                    parallel_overscan_width, segments, random_seed=random_seed)
 
         return image
 
@@ -113,15 +123,16 @@ class ImageSimulator:
         Args:
             num_fe55_hits (int): Number of Fe55 x-ray hits to perform.
             stamp_length (int): Side length of desired Fe55 postage stamp.
-            random_seed (float): Random number generator seed.
             psf_fwhm (float): FWHM of sensor PSF.
             hit_flux (int): Total flux per Fe55 x-ray hit.
             hit_hlr (float): Half-light radius of Fe55 x-ray hits.
         """
+        rngs = self.spawn_generators()
         for i in range(1, 17):
             self.segments[i].fe55_exp(num_fe55_hits, stamp_length=stamp_length, 
                                       random_seed=None, psf_fwhm=psf_fwhm, 
-                                      hit_flux=hit_flux, hit_hlr=hit_hlr)
+                                      hit_flux=hit_flux, hit_hlr=hit_hlr,
+                                      rng=rngs[i])
 
     def flatfield_exp(self, signal, noise=True):
         """Simulate a flat field exposure.
@@ -133,8 +144,26 @@ class ImageSimulator:
             signal (float): Signal level of the flat field.
             noise (bool): Specifies inclusion of shot noise.
         """
+        rngs = self.spawn_generators()
         for i in range(1, 17):            
-            self.segments[i].flatfield_exp(signal, noise=noise)
+            self.segments[i].flatfield_exp(signal, noise=noise, rng=rngs[i])
+
+    def spawn_generators(self):
+        """Spawn independent random number generators for each segment.
+
+        A new set of generators is spawned from the image seed sequence for every
+        simulated exposure or readout.  Results are reproducible for a given
+        random seed, regardless of the order or process in which segments are 
+        simulated.
+
+        Returns:
+            Dictionary of `numpy.random.Generator` objects.
+        """
+        exposure_sequence = self.seed_sequence.spawn(1)[0]
+        rngs = {amp : np.random.default_rng(amp_sequence) 
+                for amp, amp_sequence in zip(range(1, 17), exposure_sequence.spawn(16))}
+
+        return rngs
 
     def segment_readout(self, segarr_dict, amp, **kwargs):
         """Simulate readout of a single segment.
@@ -152,7 +181,8 @@ class ImageSimulator:
         segarr_dict[amp] = im
             
     def image_readout(self, template_file, bitpix=32, outfile='simulated_image.fits', 
-                use_multiprocessing=False, **kwargs):
+                use_multiprocessing=False, use_threading=False, max_workers=None, 
+                **kwargs):
         """Perform the serial readout of all CCD segments.
 
         This method simulates the serial readout for each segment of the CCD,
@@ -164,7 +194,9 @@ class ImageSimulator:
             template_file (str): Filepath to existing FITs file to use as template.
             bitpix (int): Representation of output array data type.
             outfile (str): Filepath for desired output data file.
-            do_multiprocessing (bool): Specifies usage of multiprocessing module.
+            use_multiprocessing (bool): Specifies usage of a pool of worker processes.
+            use_threading (bool): Specifies usage of a pool of worker threads.
+            max_workers (int): Maximum number of worker processes or threads.
             kwds ('dict'): Keyword arguments for Astropy `HDUList.writeto()`.
 
         Returns:
@@ -174,20 +206,19 @@ class ImageSimulator:
         output.append(fits.PrimaryHDU())
 
         ## Segment readout using single or multiprocessing
+        rngs = self.spawn_generators()
         if use_multiprocessing:
-            manager = mp.Manager()
-            segarr_dict = manager.dict()
-            job = [mp.Process(target=self.segment_readout, 
-                              args=(segarr_dict, amp, do_bias_drift),
-                              kwargs=kwargs) for amp in range(1, 17)]
+            segarr_dict = self.parallel_readout(max_workers=max_workers, rngs=rngs, 
+                                                **kwargs)
 
-            _ = [p.start() for p in job]
-            _ = [p.join() for p in job]
+        elif use_threading:
+            segarr_dict = self.threaded_readout(max_workers=max_workers, rngs=rngs, 
+                                                **kwargs)
 
         else:
             segarr_dict = {}
             for amp in range(1, 17):
-                self.segment_readout(segarr_dict, amp, **kwargs)
+                self.segment_readout(segarr_dict, amp, rng=rngs[amp], **kwargs)
 
         ## Write results to FITs file
         with fits.open(template_file) as template:
@@ -203,6 +234,86 @@ class ImageSimulator:
             
         return segarr_dict
 
+    def parallel_readout(self, max_workers=None, rngs=None, **kwargs):
+        """Simulate readout of all segments using a pool of worker processes.
+
+        Segment images are shipped to, and readout images received from, the
+        worker processes through shared memory buffers.  Each segment is read out
+        with its own random number generator, so the results do not depend on 
+        the number of worker processes.
+
+        Args:
+            max_workers (int): Maximum number of worker processes.
+            rngs ('dict' of 'numpy.random.Generator'): Random number generator
+                for each segment.
+
+        Returns:
+            Dictionary of NumPy arrays.
+        """
+        ncols = self.nx + self.prescan_width
+        input_shape = (16, self.ny, ncols)
+        output_shape = (16, self.ny + self.parallel_overscan_width, 
+                        ncols + self.serial_overscan_width)
+
+        ## Shared memory buffers for segment images
+        dtype = np.dtype(self.segments[1].dtype)
+        ctype = np.ctypeslib.as_ctypes_type(dtype)
+        shared_input = multiprocessing.RawArray(ctype, int(np.prod(input_shape)))
+        shared_output = multiprocessing.RawArray(ctype, int(np.prod(output_shape)))
+        input_arrays = np.frombuffer(shared_input, dtype=dtype).reshape(input_shape)
+        output_arrays = np.frombuffer(shared_output, dtype=dtype).reshape(output_shape)
+
+        segments = {}
+        for amp in range(1, 17):
+            input_arrays[amp-1] = self.segments[amp].segarr
+            segments[amp] = copy.copy(self.segments[amp])
+            segments[amp].segarr = None
+        if rngs is None:
+            rngs = self.spawn_generators()
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_readout_worker,
+                                 initargs=(shared_input, shared_output, 
+                                           input_shape, output_shape, dtype)) as executor:
+            futures = [executor.submit(_readout_worker, amp, segments[amp], rngs[amp],
+                                       self.serial_overscan_width, 
+                                       self.parallel_overscan_width, kwargs)
+                       for amp in range(1, 17)]
+            for future in futures:
+                future.result()
+
+        segarr_dict = {amp : output_arrays[amp-1] for amp in range(1, 17)}
+
+        return segarr_dict
+
+    def threaded_readout(self, max_workers=None, rngs=None, **kwargs):
+        """Simulate readout of all segments using a pool of worker threads.
+
+        The segments are read out concurrently within a single process, sharing
+        the segment images and serial traps rather than copying them to worker
+        processes.  The transfer simulation is dominated by whole-register NumPy
+        operations, which release the GIL.
+
+        Args:
+            max_workers (int): Maximum number of worker threads.
+            rngs ('dict' of 'numpy.random.Generator'): Random number generator
+                for each segment.
+
+        Returns:
+            Dictionary of NumPy arrays.
+        """
+        if rngs is None:
+            rngs = self.spawn_generators()
+
+        segarr_dict = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.segment_readout, segarr_dict, amp, 
+                                       rng=rngs[amp], **kwargs)
+                       for amp in range(1, 17)]
+            for future in futures:
+                future.result()
+
+        return segarr_dict
+
     def update_image_parameters(self, parameter_results):
         """Update CTI and output amplifier parameters for all segments."""
 
@@ -240,6 +351,24 @@ class ImageSimulator:
             def my_round(x): return x
         hdu.data = np.array(my_round(hdu.data), dtype=dtypes[bitpix])
 
+## Shared memory arrays of readout worker processes
+_worker_arrays = {}
+
+def _init_readout_worker(shared_input, shared_output, input_shape, output_shape, dtype):
+    """Attach a readout worker process to the shared segment image buffers."""
+
+    _worker_arrays['input'] = np.frombuffer(shared_input, dtype=dtype).reshape(input_shape)
+    _worker_arrays['output'] = np.frombuffer(shared_output, dtype=dtype).reshape(output_shape)
+
+def _readout_worker(amp, segment, rng, serial_overscan_width, parallel_overscan_width,
+                    kwargs):
+    """Simulate readout of a segment image held in shared memory."""
+
+    segment.segarr = _worker_arrays['input'][amp-1]
+    _worker_arrays['output'][amp-1] = segment.readout(serial_overscan_width=serial_overscan_width,
+                                                      parallel_overscan_width=parallel_overscan_width,
+                                                      rng=rng, **kwargs)
+
 class SegmentSimulator:
     """Controls the creation of simulated segment images.
 
@@ -248,15 +377,25 @@ class SegmentSimulator:
         ncols (int): Number of columns.
         num_serial_prescan (int): Number of serial prescan pixels.
         image (numpy.array): NumPy array containg the image pixels.
+        dtype (numpy.dtype): Floating point type of the image and readout arrays.
+
+    Single precision readout (`dtype=np.float32`) halves the memory used by
+    the simulation.  For CTI of 1e-6 and linear, logistic and spline serial traps
+    of up to 20 e-, the readout of ITL ramp and random segments with signals from
+    100 e- to 100000 e- differs from the double precision readout by at most 1e-6 
+    of the pixel signal (median 1e-7), and by less than 1e-4 e- in the serial 
+    overscan, far below the read noise and the quantization of output images.
     """
 
-    def __init__(self, imarr, prescan_width, output_amplifier, cti=0.0, traps=None):
+    def __init__(self, imarr, prescan_width, output_amplifier, cti=0.0, traps=None,
+                 dtype=np.float64):
 
         ## Image array geometry
         self.prescan_width = prescan_width
         self.ny, self.nx = imarr.shape
+        self.dtype = np.dtype(dtype)
 
-        self.segarr = np.zeros((self.ny, self.nx+prescan_width))
+        self.segarr = np.zeros((self.ny, self.nx+prescan_width), dtype=self.dtype)
         self.segarr[:, prescan_width:] = imarr
 
         ## Serial readout information
@@ -267,6 +406,7 @@ class SegmentSimulator:
         
         self.serial_traps = None
         self.do_trapping = False
+        self._plan = None
         if traps is not None:
             if not isinstance(traps, list):
                 traps = [traps]
@@ -274,7 +414,8 @@ class SegmentSimulator:
                 self.add_trap(trap)
 
     @classmethod
-    def from_amp_geom(cls, amp_geom, output_amplifier, cti=0.0, traps=None):
+    def from_amp_geom(cls, amp_geom, output_amplifier, cti=0.0, traps=None, 
+                      dtype=np.float64):
         """Create SegmentSimulator object from AmplifierGeometry object.
 
         This method takes an existing AmplifierGeometry object and uses this to
@@ -285,12 +426,14 @@ class SegmentSimulator:
             output_amplifier (OutputAmplifier): Output amplifier for the segment.
             cti (float): CTI value for the segment.
             traps (list of SerialTrap): Traps to include in the serial register.
+            dtype (numpy.dtype): Floating point type of the image arrays.
         """
 
         prescan_width = amp_geom.prescan_width
         imarr = np.zeros((amp_geom.ny, amp_geom.nx))
 
-        segment = cls(imarr, prescan_width, output_amplifier, cti=cti, traps=traps)
+        segment = cls(imarr, prescan_width, output_amplifier, cti=cti, traps=traps,
+                      dtype=dtype)
 
         return segment
 
@@ -308,7 +451,7 @@ class SegmentSimulator:
             self.do_trapping = True
 
     def fe55_exp(self, num_fe55_hits, stamp_length=6, random_seed=None, psf_fwhm=0.00016, 
-                 hit_flux=1620, hit_hlr=0.004):
+                 hit_flux=1620, hit_hlr=0.004, rng=None):
         """Simulate an Fe55 exposure.
 
         This method simulates a Fe55 soft x-ray segment image using the Galsim module.  
@@ -322,21 +465,25 @@ class SegmentSimulator:
             psf_fwhm (float): FWHM of sensor PSF.
             hit_flux (int): Total flux per Fe55 x-ray hit.
             hit_hlr (float): Half-light radius of Fe55 x-ray hits.
+            rng (numpy.random.Generator): Random number generator.
         """
+        if rng is None:
+            rng = np.random.default_rng()
+
         for i in range(num_fe55_hits):
             
             stamp = self.sim_fe55_hit(random_seed=random_seed, stamp_length=stamp_length,
                                       psf_fwhm=psf_fwhm, hit_flux=hit_flux, 
-                                      hit_hlr=hit_hlr).array
+                                      hit_hlr=hit_hlr, rng=rng).array
             sy, sx = stamp.shape
 
-            y0 = np.random.randint(0, self.ny-sy)
-            x0 = np.random.randint(self.prescan_width,
-                                   self.nx+self.prescan_width-sx)
+            y0 = rng.integers(0, self.ny-sy)
+            x0 = rng.integers(self.prescan_width,
+                              self.nx+self.prescan_width-sx)
 
             self.segarr[y0:y0+sy, x0:x0+sx] += stamp
 
-    def flatfield_exp(self, signal, noise=True):
+    def flatfield_exp(self, signal, noise=True, rng=None):
         """Simulate a flat field exposure.
 
         This method simulates a flat field segment image with given signal level.
@@ -345,9 +492,13 @@ class SegmentSimulator:
         Args:
             signal (float): Signal level of the flat field.
             noise (bool): Specifies inclusion of shot noise.
+            rng (numpy.random.Generator): Random number generator.
         """
+        if rng is None:
+            rng = np.random.default_rng()
+
         if noise:
-            flat = np.random.poisson(signal, size=(self.ny, self.nx))
+            flat = rng.poisson(signal, size=(self.ny, self.nx))
         else:
             flat = np.ones((self.ny, self.nx))*signal
         self.segarr[:, self.prescan_width:] += flat
@@ -376,7 +527,7 @@ class SegmentSimulator:
 
         self.array[:, self.prescan_width:] = 0.0
 
-    def readout(self, serial_overscan_width=10, parallel_overscan_width=0, **kwargs):
+    def readout(self, serial_overscan_width=10, parallel_overscan_width=0, rng=None, **kwargs):
         """Simulate serial readout of the segment image.
 
         This method performs the serial readout of a segment image given the
@@ -385,76 +536,146 @@ class SegmentSimulator:
         desired overscan transfers  The result is a simulated final segment image,
         in ADU.
 
+        If the `reduced_pixels` keyword is given, only the last `reduced_pixels`
+        register pixels and the serial overscan are simulated in full.  The
+        transfers that precede them are folded in as proportional loss only, 
+        and the result holds only the image columns from the first simulated 
+        pixel onwards.  This is accurate when the trap and output amplifier 
+        states settle within the simulated pixels, such as for flat field rows.
+
+        If the `use_cache` keyword is True, the serial register stage output is
+        stored in, and reused from, the module `transfer_cache`, keyed by the 
+        segment image content, CTI, serial traps and number of transfers.  
+        Repeated readouts that change only the output amplifier then only 
+        re-apply the output amplifier stage.
+
+        If the `trap_table_size` keyword is given, the trapping functions of the
+        serial traps are tabulated at that many signals and interpolated 
+        linearly during readout (see `SerialTrap.tabulate`).  This is faster
+        for trapping functions with a large overhead per evaluation, such as 
+        the interpolants of `SplineTrap`, at the cost of a small interpolation 
+        error; closed-form trapping functions are evaluated faster directly.
+
+        If the `tangents` keyword is True, the derivatives of the final image
+        with respect to the CTI, the serial trap parameters and the local offset
+        `scale` and `decay_time` of a floating output amplifier are propagated 
+        through the same readout, and a tuple of the image and a dictionary of 
+        the derivative images is returned.  The derivatives are named as in 
+        `tangent_names`, and those of disabled effects are omitted.  At the kinks
+        of charge capture and of the local offset a one-sided derivative is used.
+        The readout cache and trapping function tables are not used.
+
+        Rows do not interact during serial readout, so identical rows of the
+        segment image, such as those of noiseless flat field and ramp images,
+        are simulated once and copied before read noise is added.
+
         Args:
             segment (SegmentSimulator): Simulated segment image to process.
             serial_register (SerialRegister): Serial register to use during readout.
             num_serial_overscan (int): Number of serial overscan pixels.
             num_parallel_overscan (int): Number of parallel overscan pixels.
+            rng (numpy.random.Generator): Random number generator for read noise.
 
         Returns:
             NumPy array.
         """
-        ## Create output array
-        iy = int(self.ny + parallel_overscan_width)
-        ix = int(self.nx + self.prescan_width + serial_overscan_width)
-        image = np.random.normal(loc=self.output_amplifier.global_offset, 
-                                 scale=self.output_amplifier.noise, 
-                                 size=(iy, ix))
-        free_charge = copy.deepcopy(self.segarr)
-
-        ## Keyword override toggles
-        if kwargs.get('no_trapping', False):
-            do_trapping = False
-        else:
-            do_trapping = self.do_trapping
-        if kwargs.get('no_local_offset', False):
-            do_local_offset = False
+        ## Trap state is held on private copies, so segments may share traps
+        if self.do_trapping:
+            traps = [copy.copy(trap) for trap in self.serial_traps]
         else:
-            do_local_offset = self.output_amplifier.do_local_offset
-        if kwargs.get('no_cti', False):
-            cti = 0.0
+            traps = None
+        image = self._readout(self.cti, traps, self.output_amplifier,
+                              serial_overscan_width, parallel_overscan_width, 
+                              rng=rng, **kwargs)
+
+        return image
+
+    def batch_readout(self, ctis, traps=None, output_amplifiers=None, 
+                      serial_overscan_width=10, parallel_overscan_width=0, rng=None,
+                      **kwargs):
+        """Simulate serial readout of the segment image for a batch of parameters.
+
+        This method performs the serial readout of the segment image once for 
+        each set of CTI, serial traps and output amplifier, with all parameter sets
+        simulated together in a single vectorized readout along a leading batch axis.
+        The traps for each parameter set must match in number, type and location,
+        and the output amplifiers must be of the same type.
+
+        Args:
+            ctis ('list' of 'float'): CTI value for each parameter set.
+            traps ('list' of 'SerialTrap'): Serial traps for each parameter set.
+            output_amplifiers ('list' of 'OutputAmplifier'): Output amplifier for 
+                each parameter set.
+            serial_overscan_width (int): Number of serial overscan pixels.
+            parallel_overscan_width (int): Number of parallel overscan pixels.
+            rng (numpy.random.Generator): Random number generator for read noise.
+
+        Returns:
+            NumPy array.
+
+        Raises:
+            ValueError: If the parameter sets differ in number.
+        """
+        if output_amplifiers is None:
+            output_amplifiers = [self.output_amplifier]*len(ctis)
+        ctis, stacked_traps, stacked_amplifier = stack_readout_components(ctis, traps,
+                                                                          output_amplifiers)
+
+        image = self._readout(ctis, stacked_traps, stacked_amplifier,
+                              serial_overscan_width, parallel_overscan_width, 
+                              rng=rng, **kwargs)
+
+        return image
+
+    def readout_plan(self, serial_overscan_width=10, parallel_overscan_width=0):
+        """Return the readout plan of the segment for the given overscan geometry.
+
+        The plan is cached on the segment and reused by later readouts, so its
+        work buffers are allocated once.  It is updated to the current CTI, 
+        output amplifier and copies of the serial traps of the segment.
+
+        Args:
+            serial_overscan_width (int): Number of serial overscan pixels.
+            parallel_overscan_width (int): Number of parallel overscan pixels.
+
+        Returns:
+            ReadoutPlan.
+        """
+        if self.do_trapping:
+            traps = [copy.copy(trap) for trap in self.serial_traps]
         else:
-            cti = self.cti
-        
-        offset = np.zeros(self.ny)
-        cte = 1 - cti
-        if do_trapping:
-            for trap in self.serial_traps:
-                trap.initialize(self.ny, self.nx, self.prescan_width)
-            
-        for i in range(ix):
-
-             ## Trap capture
-            if do_trapping:
-                for trap in self.serial_traps:
-                    captured_charge = trap.trap_charge(free_charge)
-                    free_charge -= captured_charge
-
-            ## Pixel-to-pixel proportional loss
-            transferred_charge = free_charge*cte
-            deferred_charge = free_charge*cti
-
-            ## Pixel transfer and readout
-            if do_local_offset:
-                offset = self.output_amplifier.local_offset(offset, 
-                                                            transferred_charge[:, 0])
-                image[:iy-parallel_overscan_width, i] += transferred_charge[:, 0] + offset
-            else:
-                image[:iy-parallel_overscan_width, i] += transferred_charge[:, 0]
-            free_charge = np.pad(transferred_charge, ((0, 0), (0, 1)), 
-                                 mode='constant')[:, 1:] + deferred_charge
-
-            ## Trap emission
-            if do_trapping:
-                for trap in self.serial_traps:
-                    released_charge = trap.release_charge()
-                    free_charge += released_charge
-
-        return image/float(self.output_amplifier.gain)
+            traps = None
+
+        plan = self._cached_plan(serial_overscan_width, parallel_overscan_width)
+        plan.update(self.cti, self.output_amplifier, traps=traps)
+
+        return plan
+
+    def _cached_plan(self, serial_overscan_width, parallel_overscan_width):
+        """Return the cached readout plan of the segment, set to the given overscan geometry."""
+
+        if self._plan is None:
+            self._plan = ReadoutPlan(self.cti, self.output_amplifier)
+        self._plan.serial_overscan_width = serial_overscan_width
+        self._plan.parallel_overscan_width = parallel_overscan_width
+
+        return self._plan
+
+    def _readout(self, cti, traps, output_amplifier, serial_overscan_width, 
+                 parallel_overscan_width, rng=None, **kwargs):
+        """Simulate serial readout for given CTI, serial traps and output amplifier.
+
+        A batch of readouts is performed if the CTI is an array, in which case
+        the serial traps and output amplifier must be stacked to the same batch size.
+        """
+        plan = self._cached_plan(serial_overscan_width, parallel_overscan_width)
+        plan.update(cti, output_amplifier, traps=traps)
+
+        return plan.execute(self.segarr, rng=rng, **kwargs)
         
     @staticmethod
     def sim_fe55_hit(random_seed=None, stamp_length=6, psf_fwhm=0.00016,
-                     hit_flux=1620, hit_hlr=0.004):
+                     hit_flux=1620, hit_hlr=0.004, rng=None):
         """Simulate an Fe55 postage stamp.
 
         A single Fe55 x-ray hit is simulated using Galsim.  This simulates
@@ -467,10 +688,14 @@ class SegmentSimulator:
             psf_fwhm (float): FWHM of sensor PSF.
             hit_flux (int): Total flux per Fe55 x-ray hit.
             hit_hlr (float): Half-light radius of Fe55 x-ray hits.
+            rng (numpy.random.Generator): Random number generator, used for the
+                stamp offset and, if no seed is given, to seed Galsim.
 
         Returns:
             NumPy array.
         """
+        if rng is None:
+            rng = np.random.default_rng()
         
         ## Set image parameters
         pixel_scale = 0.2
@@ -479,7 +704,7 @@ class SegmentSimulator:
         gal_flux = hit_flux
         gal_hlr = hit_hlr
         gal_e = 0.0
-        dy, dx = np.random.rand(2)-0.5
+        dy, dx = rng.random(2)-0.5
 
         ## Set galsim parameters
         gsparams = galsim.GSParams(folding_threshold=1.e-2,
@@ -489,10 +714,9 @@ class SegmentSimulator:
                                    shoot_accuracy=1.e-4,
                                    minimum_fft_size=64)
         
-        if random_seed is not None:
-            rng = galsim.UniformDeviate(random_seed)
-        else:
-            rng = galsim.UniformDeviate(0)
+        if random_seed is None:
+            random_seed = int(rng.integers(1, 2**31))
+        deviate = galsim.UniformDeviate(random_seed)
         
         ## Generate stamp with Gaussian image
         image = galsim.ImageF(sy, sx, scale=pixel_scale)
@@ -501,33 +725,661 @@ class SegmentSimulator:
         gal = gal.withFlux(gal_flux)
         gal = gal.dilate(gal_hlr)
         final = galsim.Convolve([gal, psf])
-        sensor = galsim.sensor.SiliconSensor(rng=rng, diffusion_factor=1)
-        stamp = final.drawImage(image, method='phot', rng=rng,
+        sensor = galsim.sensor.SiliconSensor(rng=deviate, diffusion_factor=1)
+        stamp = final.drawImage(image, method='phot', rng=deviate,
                                 offset=(dx,dy),sensor=sensor)
 
         return stamp
 
     @staticmethod
-    def sim_star(flux, psf_fwhm, stamp_length=40, random_seed=None):
+    def sim_star(flux, psf_fwhm, stamp_length=40, random_seed=None, rng=None):
         """Simulate a star postage stamp."""
 
+        if rng is None:
+            rng = np.random.default_rng()
+
         ## Set image parameters
         pixel_scale = 0.2
         sy =  sx = stamp_length
         psf_fwhm = psf_fwhm
-        dy, dx = np.random.rand(2)-0.5
+        dy, dx = rng.random(2)-0.5
 
-        if random_seed is not None:
-            rng = galsim.UniformDeviate(random_seed)
-        else:
-            rng = galsim.UniformDeviate(0)
+        if random_seed is None:
+            random_seed = int(rng.integers(1, 2**31))
+        deviate = galsim.UniformDeviate(random_seed)
 
         ## Generate stamp with PSF image
         image = galsim.ImageF(sy, sx, scale=pixel_scale)
         psf = galsim.Kolmogorov(fwhm=psf_fwhm, scale_unit=galsim.arcsec)
         psf = psf.withFlux(flux)
-        sensor = galsim.sensor.SiliconSensor(rng=rng, diffusion_factor=1)
-        stamp = psf.drawImage(image, rng=rng, offset=(dx, dy), sensor=sensor)
+        sensor = galsim.sensor.SiliconSensor(rng=deviate, diffusion_factor=1)
+        stamp = psf.drawImage(image, rng=deviate, offset=(dx, dy), sensor=sensor)
 
         return stamp
 
+def stack_readout_components(ctis, traps, output_amplifiers):
+    """Stack the CTI, serial traps and output amplifiers of a batch of readouts.
+
+    Args:
+        ctis ('list' of 'float'): CTI value for each parameter set.
+        traps ('list' of 'SerialTrap'): Serial traps for each parameter set, or None.
+        output_amplifiers ('list' of 'OutputAmplifier'): Output amplifier for 
+            each parameter set.
+
+    Returns:
+        Tuple of the CTI array, the list of stacked serial traps (or None) and
+        the stacked output amplifier.
+
+    Raises:
+        ValueError: If the parameter sets differ in number.
+    """
+    ctis = np.asarray(ctis, dtype=np.float64)
+    if ctis.ndim != 1:
+        raise ValueError("ctis must be a 1-D sequence of CTI values.")
+    num_sets = ctis.shape[0]
+
+    ## Stack serial traps position by position
+    if traps is None:
+        stacked_traps = None
+    else:
+        traps = [trap if isinstance(trap, list) else [trap] for trap in traps]
+        if len(traps) != num_sets or len(set(len(t) for t in traps)) != 1:
+            raise ValueError("Each parameter set must have the same number of traps.")
+        stacked_traps = [SerialTrap.stack(list(t)) for t in zip(*traps)]
+
+    ## Stack output amplifiers
+    if len(output_amplifiers) != num_sets:
+        raise ValueError("Each parameter set must have an output amplifier.")
+    stacked_amplifier = BaseOutputAmplifier.stack(output_amplifiers)
+
+    return ctis, stacked_traps, stacked_amplifier
+
+class ReadoutPlan:
+    """Reusable serial readout of segment images.
+
+    A readout plan holds the CTI, serial traps and output amplifier of a serial
+    readout, together with the work buffers of the simulation.  The plan can be
+    executed repeatedly on new segment arrays, and the work buffers are reused 
+    whenever the array shapes are unchanged, so repeated readouts with the same
+    geometry, such as in fitting loops, do not reallocate them.  Parameters can
+    be changed between executions with `update`.  A plan must not be executed 
+    from more than one thread at a time.
+
+    Attributes:
+        cti (float or numpy.ndarray): Proportional loss per pixel transfer.
+        traps ('list' of 'SerialTrap'): Serial traps, or None.
+        output_amplifier (BaseOutputAmplifier): Output amplifier.
+        serial_overscan_width (int): Number of serial overscan pixels.
+        parallel_overscan_width (int): Number of parallel overscan pixels.
+    """
+
+    def __init__(self, cti, output_amplifier, traps=None, serial_overscan_width=10,
+                 parallel_overscan_width=0):
+
+        self.cti = cti
+        self.traps = traps
+        self.output_amplifier = output_amplifier
+        self.serial_overscan_width = serial_overscan_width
+        self.parallel_overscan_width = parallel_overscan_width
+        self._buffers = {}
+
+    def __getstate__(self):
+
+        ## Work buffers are not sent to other processes
+        state = self.__dict__.copy()
+        state['_buffers'] = {}
+
+        return state
+
+    def update(self, cti, output_amplifier, traps=None):
+        """Update the CTI, output amplifier and serial traps of the plan.
+
+        A batch of readouts is performed if the CTI is an array, in which case
+        the serial traps and output amplifier must be stacked to the same batch size.
+        """
+        self.cti = cti
+        self.output_amplifier = output_amplifier
+        self.traps = traps
+
+    def buffer(self, name, shape, dtype=np.float64):
+        """Return the work buffer of a name, reallocated if the shape or type has changed."""
+
+        array = self._buffers.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = np.empty(shape, dtype=dtype)
+            self._buffers[name] = array
+
+        return array
+
+    def execute(self, segarr, rng=None, out=None, **kwargs):
+        """Simulate serial readout of a segment array.
+
+        The keyword toggles and options are those of `SegmentSimulator.readout`.
+
+        Args:
+            segarr (numpy.ndarray): Serial register pixel signals [e-], including
+                the serial prescan.  The readout is simulated in the floating 
+                point type of the array.
+            rng (numpy.random.Generator): Random number generator for read noise.
+            out (numpy.ndarray): Optional output array for the final image [ADU].
+
+        Returns:
+            NumPy array, or a tuple of the array and a dictionary of derivative
+            arrays if the `tangents` keyword is True.
+
+        Raises:
+            ValueError: If derivatives are requested for a batch of readouts.
+        """
+        traps = self.traps
+        output_amplifier = self.output_amplifier
+        batch_shape = np.shape(self.cti)
+        dtype = np.result_type(segarr.dtype, np.float32)
+
+        ## Keyword override toggles
+        if kwargs.get('no_trapping', False):
+            do_trapping = False
+        else:
+            do_trapping = traps is not None
+        if kwargs.get('no_local_offset', False):
+            do_local_offset = False
+        else:
+            do_local_offset = output_amplifier.do_local_offset
+        if kwargs.get('no_cti', False):
+            cti = np.zeros(batch_shape, dtype=dtype)
+        else:
+            cti = np.asarray(self.cti, dtype=dtype)
+        do_tangents = kwargs.get('tangents', False)
+        if do_tangents and batch_shape != ():
+            raise ValueError("Derivatives require a single readout, not a batch.")
+
+        ## Rows are read out independently, so identical rows are simulated once
+        ny, ncols = segarr.shape
+        ix = int(ncols + self.serial_overscan_width)
+        unique_segarr, row_index = unique_rows(segarr)
+        if row_index is not None:
+            segarr = unique_segarr
+
+        ## Reduced register, with leading transfers folded in as proportional loss
+        reduced_pixels = kwargs.get('reduced_pixels', None)
+        segarr_tangent = None
+        if reduced_pixels is not None and reduced_pixels < ncols:
+            num_skipped = ncols - reduced_pixels
+            if do_tangents:
+                segarr_tangent = cti_register(segarr.astype(np.float64), cti, num_skipped, 
+                                              reduced_pixels, derivative=True)
+            segarr = cti_register(segarr, cti, num_skipped, reduced_pixels)
+            ncols = segarr.shape[-1]
+            ix -= num_skipped
+
+        ## Serial register stage
+        if not do_trapping:
+            traps = None
+        table_size = kwargs.get('trap_table_size', None)
+        if do_tangents:
+            signals, signal_tangents = serial_transfer_tangents(segarr, cti, ix, traps=traps,
+                                                                segarr_tangent=segarr_tangent)
+            names = tangent_names(traps)
+        elif kwargs.get('use_cache', False):
+            key = transfer_cache.key(segarr, cti, ix, traps) + (table_size,)
+            signals = transfer_cache.get(key)
+            if signals is None:
+                signals = serial_transfer(segarr, cti, ix, traps=traps, 
+                                          table_size=table_size)
+                transfer_cache.put(key, signals)
+            signals = signals.copy()
+        else:
+            signals = serial_transfer(segarr, cti, ix, traps=traps, allocate=self.buffer,
+                                      table_size=table_size)
+
+        ## Output amplifier stage
+        iy = int(ny + self.parallel_overscan_width)
+        if out is None:
+            out = np.empty(batch_shape+(iy, ix), dtype=dtype)
+        if kwargs.get('no_noise', False):
+            out[...] = output_amplifier.global_offset
+        else:
+            if rng is None:
+                rng = np.random.default_rng()
+            rng.standard_normal(dtype=out.dtype, out=out)
+            out *= output_amplifier.noise
+            out += output_amplifier.global_offset
+        if do_tangents and do_local_offset:
+            index = {'scale' : len(names), 'decay_time' : len(names)+1}
+            names += ['scale', 'decay_time']
+            signal_tangents = np.concatenate((signal_tangents, 
+                                              np.zeros((2,)+signals.shape)))
+            offsets, offset_tangents = output_amplifier.local_offset_tangents(signals, 
+                                                                              signal_tangents,
+                                                                              index)
+            signals += offsets.astype(dtype)
+            signal_tangents += offset_tangents
+        elif do_local_offset:
+            signals += output_amplifier.local_offsets(signals)
+        if row_index is not None:
+            signals = signals[..., row_index, :]
+        out[..., :ny, :] += signals
+        out /= output_amplifier.gain
+
+        if do_tangents:
+            if row_index is not None:
+                signal_tangents = signal_tangents[:, row_index, :]
+            tangents = {}
+            for name, signal_tangent in zip(names, signal_tangents):
+                if name == 'cti' and kwargs.get('no_cti', False):
+                    continue
+                tangent = np.zeros((iy, ix))
+                tangent[:ny, :] = signal_tangent/output_amplifier.gain
+                tangents[name] = tangent
+            return out, tangents
+
+        return out
+
+class TransferCache:
+    """Least recently used cache of serial register stage outputs.
+
+    Entries are keyed by a hash of the serial register pixel signals together 
+    with the CTI, the serial trap parameters and the number of transfers, 
+    so that readouts that differ only in the output amplifier share the 
+    serial register stage.
+
+    Attributes:
+        maxsize (int): Maximum number of cached outputs.
+    """
+
+    def __init__(self, maxsize=8):
+
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(segarr, cti, num_transfers, traps=None):
+        """Return the cache key for a serial register stage."""
+
+        segarr = np.ascontiguousarray(segarr)
+        digest = hashlib.sha1(segarr).hexdigest()
+        cti = np.asarray(cti, dtype=segarr.dtype)
+        if traps is None:
+            trap_keys = None
+        else:
+            trap_keys = tuple(trap.cache_key() for trap in traps)
+
+        return (digest, segarr.dtype.str, segarr.shape, cti.shape, cti.tobytes(), 
+                num_transfers, trap_keys)
+
+    def get(self, key):
+        """Return the cached output for a key, or None if not cached."""
+
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self._entries[key]
+
+    def put(self, key, signals):
+        """Store an output, discarding the least recently used outputs if full."""
+
+        with self._lock:
+            self._entries[key] = signals
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Discard all cached outputs."""
+
+        with self._lock:
+            self._entries.clear()
+
+transfer_cache = TransferCache()
+
+def unique_rows(arr):
+    """Find the unique rows of a 2-D array.
+
+    Rows are first compared by a random projection, which is confirmed exactly,
+    falling back to a full comparison of the rows if two rows share a projection.
+
+    Args:
+        arr (numpy.ndarray): 2-D array.
+
+    Returns:
+        Tuple of the unique rows and the indices of the unique row of each row,
+        or of the array and None if all rows are unique.
+    """
+    weights = np.random.default_rng(0).random(arr.shape[1])
+    projection = np.sum(arr*weights, axis=1)
+    _, first_index, row_index = np.unique(projection, return_index=True, 
+                                          return_inverse=True)
+    if first_index.shape[0] == arr.shape[0]:
+        return arr, None
+
+    unique_arr = arr[first_index]
+    row_index = row_index.reshape(-1)
+    if not np.array_equal(unique_arr[row_index], arr):
+        unique_arr, row_index = np.unique(arr, axis=0, return_inverse=True)
+        if unique_arr.shape[0] == arr.shape[0]:
+            return arr, None
+        row_index = row_index.reshape(-1)
+
+    return unique_arr, row_index
+
+def serial_transfer(segarr, cti, num_transfers, traps=None, allocate=None, 
+                    table_size=None):
+    """Calculate the output pixel signals of the serial register.
+
+    The serial register is transferred `num_transfers` times with proportional loss
+    and, optionally, charge capture and release by serial traps; the signal 
+    transferred out of the register at each transfer is recorded.  Without traps 
+    the transfer is linear and is calculated directly by `cti_transfer`.
+
+    Charge only moves towards the output, so the register pixels beyond the
+    last trap see proportional loss only.  Just the pixels up to the last trap
+    are transferred step by step, and the charge that flows into them from 
+    beyond is calculated directly by `cti_transfer`.  The cost of the readout
+    is then independent of the number of empty pixels in each row.
+
+    An array of CTI values produces a readout for each value, along leading axes,
+    in which case the serial traps must be stacked to the same batch size.
+    The readout is simulated in the floating point type of the pixel signals.
+
+    Args:
+        segarr (numpy.ndarray): Serial register pixel signals [e-].
+        cti (float or numpy.ndarray): Proportional loss per pixel transfer.
+        num_transfers (int): Number of serial transfers to perform.
+        traps ('list' of 'SerialTrap'): Serial traps, which are reinitialized.
+        allocate (callable): Function returning a work array for a name, shape
+            and type, such as `ReadoutPlan.buffer`.  New arrays are used by default.
+        table_size (int): If given, the trapping functions are tabulated at this
+            many signals up to the largest pixel signal (see `SerialTrap.tabulate`).
+
+    Returns:
+        NumPy array.
+    """
+    if allocate is None:
+        allocate = _allocate
+
+    dtype = np.result_type(segarr.dtype, np.float32)
+    cti = np.asarray(cti, dtype=dtype)
+    batch_shape = cti.shape
+    ny, ncols = segarr.shape[-2:]
+    if traps is None:
+        return cti_transfer(segarr, cti, num_transfers, 
+                            out=allocate('output', batch_shape+(ny, num_transfers), dtype))
+
+    cte = 1 - cti
+    max_signal = 1.01*np.max(segarr, initial=0.) if table_size is not None else None
+    for trap in traps:
+        trap.initialize(ny, ncols, 0, dtype=dtype, max_signal=max_signal, 
+                        table_size=table_size)
+
+    ## Register pixels up to the last trap, and the charge flowing into them
+    window = min(max(trap.pixel for trap in traps) + 1, ncols)
+    if window < ncols:
+        inflow = cti_transfer(segarr[..., window:], cti, num_transfers, 
+                              out=allocate('inflow', batch_shape+(ny, num_transfers), dtype))
+        inflow = np.swapaxes(inflow, -1, -2)
+    else:
+        inflow = None
+
+    ## Serial register work buffers
+    ##
+    ## The register is stored column-major and advanced by moving a view
+    ## one column along a preallocated buffer, rather than re-padding the
+    ## array at each transfer.  Columns beyond the initial register are zero.
+    register = allocate('register', batch_shape+(window+num_transfers, ny), dtype)
+    register[..., :window, :] = np.swapaxes(segarr[..., :window], -1, -2)
+    register[..., window:, :] = 0.
+    deferred_charge = allocate('deferred_charge', batch_shape+(window, ny), dtype)
+    output = allocate('transposed_output', batch_shape+(num_transfers, ny), dtype)
+    column_cte = cte[..., None]
+    frame_cti = cti[..., None, None]
+    frame_cte = cte[..., None, None]
+            
+    for i in range(num_transfers):
+
+        free_charge = register[..., i:i+window, :]
+
+        ## Trap capture
+        for trap in traps:
+            captured_charge = trap.trap_charge(free_charge[..., trap.pixel, :])
+            free_charge[..., trap.pixel, :] -= captured_charge
+
+        ## Pixel-to-pixel proportional loss
+        np.multiply(free_charge[..., 0, :], column_cte, out=output[..., i, :])
+        np.multiply(free_charge, frame_cti, out=deferred_charge)
+
+        ## Pixel transfer
+        free_charge = register[..., i+1:i+window+1, :]
+        free_charge *= frame_cte
+        free_charge += deferred_charge
+        if inflow is not None:
+            free_charge[..., window-1, :] += inflow[..., i, :]
+
+        ## Trap emission
+        for trap in traps:
+            released_charge = trap.release_charge()
+            free_charge[..., trap.pixel, :] += released_charge
+
+    return np.swapaxes(output, -1, -2)
+
+def serial_transfer_tangents(segarr, cti, num_transfers, traps=None, segarr_tangent=None):
+    """Calculate the output pixel signals of the serial register and their derivatives.
+
+    The serial register is transferred as in `serial_transfer`, and the derivatives
+    of the charge with respect to the CTI and the serial trap parameters are 
+    propagated alongside it (forward mode differentiation), in the order of 
+    `tangent_names`.  At the kinks of charge capture the derivatives are taken
+    as described in `SerialTrap.trap_charge_tangents`.  The readout is 
+    calculated in double precision for a single CTI value, and the trapping
+    functions are evaluated directly rather than tabulated.
+
+    Args:
+        segarr (numpy.ndarray): Serial register pixel signals [e-].
+        cti (float): Proportional loss per pixel transfer.
+        num_transfers (int): Number of serial transfers to perform.
+        traps ('list' of 'SerialTrap'): Serial traps, which are reinitialized.
+        segarr_tangent (numpy.ndarray): Derivative of the pixel signals with 
+            respect to the CTI, such as for a reduced register.  Zero by default.
+
+    Returns:
+        Tuple of the output pixel signals and their derivatives, along a leading axis.
+
+    Raises:
+        ValueError: If the CTI is not a single value.
+    """
+    if np.ndim(cti) != 0:
+        raise ValueError("Derivatives require a single CTI value.")
+    cti = float(cti)
+    cte = 1 - cti
+    dtype = np.result_type(segarr.dtype, np.float32)
+    ny, ncols = segarr.shape
+    names = tangent_names(traps)
+    num_tangents = len(names)
+
+    if traps is None:
+        output = cti_transfer(segarr, cti, num_transfers)
+        tangents = np.zeros((num_tangents, ny, num_transfers))
+        tangents[0] = cti_transfer(segarr, cti, num_transfers, derivative=True)
+        if segarr_tangent is not None:
+            tangents[0] += cti_transfer(segarr_tangent, cti, num_transfers)
+        return output, tangents
+
+    for i, trap in enumerate(traps):
+        trap.initialize(ny, ncols, 0)
+        index = {keyword : names.index('trap{0}_{1}'.format(i, keyword)) + 1
+                 for keyword in trap.parameter_names()}
+        trap.initialize_tangents(index, num_tangents)
+
+    ## Register pixels up to the last trap, and the charge flowing into them
+    window = min(max(trap.pixel for trap in traps) + 1, ncols)
+    if window < ncols:
+        inflow = np.empty((2, ny, num_transfers))
+        inflow[0] = cti_transfer(segarr[:, window:], cti, num_transfers)
+        inflow[1] = cti_transfer(segarr[:, window:], cti, num_transfers, derivative=True)
+        if segarr_tangent is not None:
+            inflow[1] += cti_transfer(segarr_tangent[:, window:], cti, num_transfers)
+        inflow = np.swapaxes(inflow, -1, -2)
+    else:
+        inflow = None
+
+    ## Serial register, stored column-major
+    ##
+    ## The first entry of the leading axis holds the charge and the following
+    ## entries hold its derivatives, so that the linear steps of the transfer 
+    ## are shared.  The CTI derivative, in the second entry, is completed with
+    ## the derivative of the CTI itself at each step.
+    register = np.zeros((num_tangents+1, window+num_transfers, ny))
+    register[0, :window] = segarr[:, :window].T
+    if segarr_tangent is not None:
+        register[1, :window] = segarr_tangent[:, :window].T
+    output = np.empty((num_tangents+1, num_transfers, ny))
+
+    for i in range(num_transfers):
+
+        free_charge = register[:, i:i+window]
+
+        ## Trap capture
+        for trap in traps:
+            free_charge[:, trap.pixel] -= trap.trap_charge_tangents(free_charge[:, trap.pixel])
+
+        ## Pixel-to-pixel proportional loss
+        np.multiply(free_charge[:, 0], cte, out=output[:, i])
+        output[1, i] -= free_charge[0, 0]
+        deferred_charge = free_charge*cti
+        deferred_charge[1] += free_charge[0]
+
+        ## Pixel transfer
+        free_charge = register[:, i+1:i+window+1]
+        deferred_charge[1] -= free_charge[0]
+        free_charge *= cte
+        free_charge += deferred_charge
+        if inflow is not None:
+            free_charge[:2, window-1] += inflow[:, i]
+
+        ## Trap emission
+        for trap in traps:
+            free_charge[:, trap.pixel] += trap.release_charge_tangents()
+
+    output = np.swapaxes(output, -1, -2)
+
+    return output[0].astype(dtype), output[1:]
+
+def tangent_names(traps=None):
+    """Return the names of the serial register derivatives, in order.
+
+    The derivative with respect to the CTI is named `cti`, and the derivatives 
+    with respect to the parameters of the trap at position `i` of `traps` are
+    named `trap<i>_<parameter>`, e.g. `trap0_size`, `trap0_emission_time` and
+    `trap0_scaling` (see `SerialTrap.parameter_names`).
+    """
+    names = ['cti']
+    for i, trap in enumerate(traps or []):
+        names += ['trap{0}_{1}'.format(i, keyword) for keyword in trap.parameter_names()]
+
+    return names
+
+def _allocate(name, shape, dtype=np.float64):
+    """Return a new work array."""
+
+    return np.empty(shape, dtype=dtype)
+
+def cti_transfer(segarr, cti, num_transfers, tol=np.finfo(np.float64).eps, out=None,
+                 derivative=False):
+    """Calculate the serial readout of a segment with only proportional loss.
+
+    With no charge trapping, a pixel signal that is transferred with proportional
+    loss is redistributed binomially into the trailing pixels.  After `i` transfers,
+    the fraction of the signal of pixel `j` that is read out at transfer `i` is
+    `(1-cti)*binom.pmf(i-j, i, cti)`.  The kernel is truncated at the number of 
+    trailing pixels where the remaining binomial tail probability falls below `tol`.
+    An array of CTI values produces a readout for each value, along leading axes.
+
+    Args:
+        segarr (numpy.ndarray): Serial register pixel signals [e-].
+        cti (float or numpy.ndarray): Proportional loss per pixel transfer.
+        num_transfers (int): Number of serial transfers to perform.
+        tol (float): Truncation tolerance for the transfer kernel.
+        out (numpy.ndarray): Optional output array.
+        derivative (bool): If True, the derivative of the readout with respect
+            to the CTI is calculated instead.
+
+    Returns:
+        NumPy array.
+    """
+    ny, ncols = segarr.shape[-2:]
+    dtype = np.result_type(segarr.dtype, np.float32)
+    cti = np.asarray(cti, dtype=np.float64)[..., None]
+    n = np.arange(num_transfers)
+
+    ## Truncated kernel width, set by the largest number of transfers
+    tail = binom.sf(n, num_transfers-1, cti)
+    width = int(np.max(np.argmax(tail <= tol, axis=-1))) + 1 + int(derivative)
+
+    if out is None:
+        output = np.zeros(cti.shape[:-1]+(ny, num_transfers), dtype=dtype)
+    else:
+        output = out
+        output.fill(0.)
+    for k in range(min(width, num_transfers)):
+        m = min(num_transfers-k, ncols)
+        if derivative:
+            weights = ((1-cti)*_binom_pmf_derivative(k, n[k:k+m], cti)
+                       - binom.pmf(k, n[k:k+m], cti)).astype(dtype)
+        else:
+            weights = ((1-cti)*binom.pmf(k, n[k:k+m], cti)).astype(dtype)
+        output[..., k:k+m] += weights[..., None, :]*segarr[..., :m]
+
+    return output
+
+def cti_register(segarr, cti, num_transfers, num_pixels, tol=np.finfo(np.float64).eps,
+                 derivative=False):
+    """Calculate the serial register pixel signals after transfers with only proportional loss.
+
+    After `n` transfers with proportional loss, the fraction of the signal of pixel 
+    `j` that is held in register pixel `j-n+k` is `binom.pmf(k, n, cti)`.  Signal
+    that has already been read out is discarded.  The result holds the first
+    `num_pixels` register pixels followed by the trailing pixels that receive 
+    deferred charge from them, up to the kernel truncation set by `tol`.
+    An array of CTI values produces a register for each value, along leading axes.
+
+    Args:
+        segarr (numpy.ndarray): Serial register pixel signals [e-].
+        cti (float or numpy.ndarray): Proportional loss per pixel transfer.
+        num_transfers (int): Number of serial transfers to perform.
+        num_pixels (int): Number of leading register pixels to return.
+        tol (float): Truncation tolerance for the transfer kernel.
+        derivative (bool): If True, the derivative of the register with respect
+            to the CTI is calculated instead.
+
+    Returns:
+        NumPy array.
+    """
+    ny, ncols = segarr.shape[-2:]
+    dtype = np.result_type(segarr.dtype, np.float32)
+    cti = np.asarray(cti, dtype=np.float64)[..., None]
+
+    ## Truncated kernel width
+    tail = binom.sf(np.arange(num_transfers+1), num_transfers, cti)
+    width = int(np.max(np.argmax(tail <= tol, axis=-1))) + 1 + int(derivative)
+    if derivative:
+        weights = _binom_pmf_derivative(np.arange(width), num_transfers, cti).astype(dtype)
+    else:
+        weights = binom.pmf(np.arange(width), num_transfers, cti).astype(dtype)
+
+    length = num_pixels + width
+    output = np.zeros(cti.shape[:-1]+(ny, length), dtype=dtype)
+    for k in range(width):
+        lo = max(0, k-num_transfers)
+        hi = min(length, ncols-num_transfers+k)
+        if hi > lo:
+            output[..., lo:hi] += weights[..., k, None, None]*segarr[..., lo+num_transfers-k:hi+num_transfers-k]
+
+    return output
+
+def _binom_pmf_derivative(k, n, p):
+    """Calculate the derivative of the binomial probability mass function with respect to `p`."""
+
+    m = np.maximum(n-1, 0)
+
+    return n*(binom.pmf(k-1, m, p) - binom.pmf(k, m, p))
@@ -19,7 +19,7 @@ import numpy as np
 from astropy.io import fits
 from lsst.eotest.sensor.AmplifierGeometry import AmplifierGeometry, amp_loc
 
-from ctisim import FloatingOutputAmplifier
+from ctisim import FloatingOutputAmplifier, SplineTrap
 
 ITL_AMP_GEOM = AmplifierGeometry(prescan=3, nx=509, ny=2000, 
                                  detxsize=4608, detysize=4096,
@@ -114,6 +114,114 @@ class OverscanParameterResults:
 
         return param_dict
 
+class DeferredChargeCalibration(OverscanParameterResults):
+    """Deferred charge calibration of all amplifiers of a sensor.
+
+    In addition to the overscan parameter results, the calibration holds the 
+    tabulated trapping function of a `SplineTrap` for each amplifier.  It is
+    stored as a single FITs file, with one binary table row per amplifier, 
+    which is read with a single (memory-mapped) file open.
+
+    Attributes:
+        sensor_id (str): Identifier for the CCD sensor.
+        cti_results ('dict' of 'float'): CTI for each amplifier.
+        drift_scales ('dict' of 'float'): Local offset drift scale for each amplifier.
+        decay_times ('dict' of 'float'): Local offset decay time for each amplifier.
+        traps ('dict' of 'SplineTrap'): Serial trap for each amplifier, or None.
+    """
+
+    version = 1
+
+    def __init__(self, sensor_id, cti_results, drift_scales, decay_times, traps=None):
+
+        super().__init__(sensor_id, cti_results, drift_scales, decay_times)
+        if traps is None:
+            traps = {ampnum : None for ampnum in range(1, 17)}
+        self.traps = traps
+
+    @classmethod
+    def from_parameter_results(cls, parameter_results, traps=None):
+        """Create a calibration from overscan parameter results and serial traps."""
+
+        calibration = cls(parameter_results.sensor_id, parameter_results.cti_results,
+                          parameter_results.drift_scales, parameter_results.decay_times,
+                          traps=traps)
+
+        return calibration
+
+    @classmethod
+    def from_fits(cls, infile):
+        """Read a calibration from a FITs file.
+
+        Raises:
+            ValueError: If the file was written by a newer calibration version.
+        """
+
+        with fits.open(infile, memmap=True) as hdulist:
+
+            sensor_id = hdulist[0].header['SENSORID']
+            version = hdulist[0].header.get('CALIBVER', 0)
+            if version > cls.version:
+                raise ValueError('Calibration version {0} is not supported.'.format(version))
+            data = hdulist['AMPLIFIERS'].data
+
+            cti_results = cls.asdict(np.array(data['CTI']))
+            drift_scales = cls.asdict(np.array(data['DRIFT_SCALE']))
+            decay_times = cls.asdict(np.array(data['DECAY_TIME']))
+
+            traps = {}
+            for ampnum in range(1, 17):
+                row = data[ampnum-1]
+                num_points = int(row['NUM_POINTS'])
+                if num_points == 0:
+                    traps[ampnum] = None
+                else:
+                    traps[ampnum] = SplineTrap.from_table(row['TRAP_SIGNAL'][:num_points],
+                                                          row['TRAP_CHARGE'][:num_points],
+                                                          float(row['EMISSION_TIME']),
+                                                          int(row['TRAP_PIXEL']))
+        results = cls(sensor_id, cti_results, drift_scales, decay_times, traps=traps)
+
+        return results
+
+    def write_fits(self, outfile, **kwargs):
+
+        hdr = fits.Header()
+        hdr['SENSORID'] = self.sensor_id
+        hdr['CALIBVER'] = self.version
+        prihdu = fits.PrimaryHDU(header=hdr)
+
+        ## Trap tables, padded to a common length
+        tables = {ampnum : self.traps[ampnum].table() 
+                  for ampnum in range(1, 17) if self.traps[ampnum] is not None}
+        length = max([len(x) for x, y in tables.values()] + [1])
+        num_points = np.zeros(16, dtype=np.int32)
+        trap_pixels = np.zeros(16, dtype=np.int32)
+        emission_times = np.zeros(16)
+        trap_signals = np.zeros((16, length))
+        trap_charges = np.zeros((16, length))
+        for ampnum, (x, y) in tables.items():
+            num_points[ampnum-1] = len(x)
+            trap_pixels[ampnum-1] = self.traps[ampnum].pixel
+            emission_times[ampnum-1] = self.traps[ampnum].emission_time
+            trap_signals[ampnum-1, :len(x)] = x
+            trap_charges[ampnum-1, :len(x)] = y
+
+        array_format = '{0}D'.format(length)
+        cols = [fits.Column(name='AMPLIFIER', array=np.arange(1, 17), format='I'),
+                fits.Column(name='CTI', array=self.asarray(self.cti_results), format='D'),
+                fits.Column(name='DRIFT_SCALE', array=self.asarray(self.drift_scales), format='D'),
+                fits.Column(name='DECAY_TIME', array=self.asarray(self.decay_times), format='D'),
+                fits.Column(name='TRAP_PIXEL', array=trap_pixels, format='J'),
+                fits.Column(name='EMISSION_TIME', array=emission_times, format='D'),
+                fits.Column(name='NUM_POINTS', array=num_points, format='J'),
+                fits.Column(name='TRAP_SIGNAL', array=trap_signals, format=array_format),
+                fits.Column(name='TRAP_CHARGE', array=trap_charges, format=array_format)]
+
+        hdu = fits.BinTableHDU.from_columns(cols, name='AMPLIFIERS')
+        hdulist = fits.HDUList([prihdu, hdu])
+        hdulist.writeto(outfile, **kwargs)
+
 def calculate_cti(imarr, last_pix_num, num_overscan_pixels=1):
     """Calculate the serial CTI of an image array.
 
@@ -5,7 +5,7 @@ from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import warnings
 import os
 
-from ctisim.correction import cti_inverse_operator, electronics_operator, trap_operator
+from ctisim.correction import cti_correction, electronics_operator, trap_operator
 from ctisim import LinearTrap, LogisticTrap, SplineTrap
 from ctisim import ImageSimulator
 from ctisim import BaseOutputAmplifier, FloatingOutputAmplifier
@@ -79,10 +79,7 @@ def main(sensor_id, infile, output_dir='./', cti=None, do_trapping=False,
 
             ## CTI Correction
             if do_cti:
-                Dinv_cti = cti_inverse_operator(cti, imarr.shape[1])
-                for i in range(imarr.shape[0]):
-
-                    corrected_imarr[i, :] = Dinv_cti*corrected_imarr[i, :]
+                corrected_imarr = cti_correction(corrected_imarr, cti)
             else:
                 pass
 
@@ -1,4 +1,5 @@
 import argparse
+import os
 from astropy.io import fits
 from astropy.utils.exceptions import AstropyWarning, AstropyUserWarning
 import warnings
@@ -8,20 +9,14 @@ import siteUtils
 
 from lsst.eotest.sensor import MaskedCCD
 from lsst.eotest.fitsTools import fitsWriteto
-from ctisim.utils import OverscanParameterResults
-from ctisim.correction import electronics_inverse_operator, trap_inverse_operator
+from ctisim.utils import DeferredChargeCalibration
+from ctisim.correction import DeferredChargeCorrector
 
 def main(sensor_id, infile, main_dir, gain_file=None, output_dir='./', no_bias=False):
 
-    ## Get existing parameter results
-    param_file = join(main_dir, 
-                              '{0}_parameter_results.fits'.format(sensor_id))
-    param_results = OverscanParameterResults.from_fits(param_file)
-    cti_results = param_results.cti_results
-    drift_scales = param_results.drift_scales
-    decay_times = param_results.decay_times
-    trap_files = [join(main_dir, 
-                       '{0}_amp{1}_trap.pkl'.format(sensor_id, i)) for i in range(1, 17)]
+    ## Get existing calibration results
+    calibration_file = join(main_dir, '{0}_calibration.fits'.format(sensor_id))
+    calibration = DeferredChargeCalibration.from_fits(calibration_file)
 
     ## Get gains
     if gain_file is not None:
@@ -51,19 +46,11 @@ def main(sensor_id, infile, main_dir, gain_file=None, output_dir='./', no_bias=F
 
             imarr = ccd.bias_subtracted_image(amp).getImage().getArray()*gains[amp]
 
-            ## Electronics Correction
-            if drift_scales[amp] > 0.:
-                Linv = electronics_inverse_operator(imarr, drift_scales[amp], 
-                                                    decay_times[amp],
-                                                    num_previous_pixels=15)
-                corrected_imarr = imarr - Linv
-            else:
-                corrected_imarr = imarr
-
-            ## Trap Correction
-            spltrap = pickle.load(open(trap_files[amp], 'rb'))
-            Tinv = trap_inverse_operator(corrected_imarr, spltrap)
-            corrected_imarr = corrected_imarr - (1-cti_results[amp])*Tinv
+            ## Electronics and Trap Correction
+            corrector = DeferredChargeCorrector.from_parameter_results(calibration, amp,
+                                                                       traps=calibration.traps[amp],
+                                                                       do_cti=False)
+            corrected_imarr = corrector.correct(imarr, out=imarr)
 
             ## Reassemble HDUList
             hdulist.append(fits.ImageHDU(data=corrected_imarr/gains[amp],
@@ -0,0 +1,65 @@
+import argparse
+import glob
+import json
+import os
+from os.path import join
+
+from ctisim.driver import FitDriver, run_summary
+from ctisim.utils import OverscanParameterResults
+
+def main(directory, raft_ids=None, max_workers=None, prior_dir=None, prior_table=None):
+
+    ## Sensor overscan results are found as <raft>/<sensor>/<raft>_<sensor>_overscan_results.fits
+    if raft_ids is None:
+        raft_ids = sorted(os.path.basename(path) for path in glob.glob(join(directory, 'R??')))
+
+    overscan_files = {}
+    output_dirs = {}
+    for raft_id in raft_ids:
+        for sensor_dir in sorted(glob.glob(join(directory, raft_id, 'S??'))):
+            sensor_id = '{0}_{1}'.format(raft_id, os.path.basename(sensor_dir))
+            overscan_file = join(sensor_dir, '{0}_overscan_results.fits'.format(sensor_id))
+            if os.path.exists(overscan_file):
+                overscan_files[sensor_id] = overscan_file
+                output_dirs[sensor_id] = sensor_dir
+    print("Fitting {0} sensors".format(len(overscan_files)))
+
+    ## Earlier results are found as <raft>/<sensor>/<raft>_<sensor>_parameter_results.fits
+    prior_results = {}
+    if prior_dir is not None:
+        for sensor_id in overscan_files:
+            raft_id, slot = sensor_id.split('_')
+            infile = join(prior_dir, raft_id, slot, 
+                          '{0}_parameter_results.fits'.format(sensor_id))
+            if os.path.exists(infile):
+                prior_results[sensor_id] = OverscanParameterResults.from_fits(infile)
+
+    ## Prior table holds parameter values, e.g. {"ctiexp" : -6.0, "decaytime" : 2.4}
+    prior = None
+    if prior_table is not None:
+        with open(prior_table) as f:
+            prior = json.load(f)
+
+    driver = FitDriver(overscan_files, output_dir=output_dirs, max_workers=max_workers,
+                       prior_results=prior_results, prior=prior)
+    failures = driver.run()
+    for line in run_summary(driver, failures):
+        print(line)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', type=str, 
+                        help='Directory holding raft and sensor overscan FITs data subdirectories.')
+    parser.add_argument('--raft_ids', '-r', type=str, nargs='+', default=None,
+                        help='Raft identifiers, e.g. R02; all rafts by default.')
+    parser.add_argument('--max_workers', '-j', type=int, default=None,
+                        help='Number of worker processes.')
+    parser.add_argument('--prior_dir', type=str, default=None,
+                        help='Directory holding parameter results of an earlier run, used to seed the fits.')
+    parser.add_argument('--prior_table', type=str, default=None,
+                        help='JSON file of prior fit parameter values, e.g. for the sensor vendor, used to seed the fits.')
+    args = parser.parse_args()
+
+    main(args.directory, raft_ids=args.raft_ids, max_workers=args.max_workers,
+         prior_dir=args.prior_dir, prior_table=args.prior_table)
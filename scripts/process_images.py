@@ -5,7 +5,7 @@ import warnings
 import os
 import pickle
 
-from ctisim.utils import OverscanParameterResults
+from ctisim.utils import DeferredChargeCalibration
 from ctisim import ImageSimulator
 
 def main(sensor_id, infile, main_dir, gain_file=None, output_dir='./', include_noise=False):
@@ -26,21 +26,15 @@ def main(sensor_id, infile, main_dir, gain_file=None, output_dir='./', include_n
 
     offset_dict = {i : 0.0 for i in range(1, 17)}
 
-    ## Get CTI and output amplifiers
-    param_file = os.path.join(main_dir, 
-                              '{0}_parameter_results.fits'.format(sensor_id))
-    param_results = OverscanParameterResults.from_fits(param_file)
-    cti_results = param_results.cti_results
-    output_amplifiers = param_results.all_output_amplifiers(gains, 
-                                                            noise_dict, 
-                                                            offset_dict)
-
-    ## Get traps
-    traps = {}
-    for i in range(1, 17):
-        trap_file = os.path.join(main_dir, 
-                                 '{0}_amp{1}_trap.pkl'.format(sensor_id, i))
-        traps[i] = pickle.load(open(trap_file, 'rb'))
+    ## Get CTI, output amplifiers and traps
+    calibration_file = os.path.join(main_dir, 
+                                    '{0}_calibration.fits'.format(sensor_id))
+    calibration = DeferredChargeCalibration.from_fits(calibration_file)
+    cti_results = calibration.cti_results
+    output_amplifiers = calibration.all_output_amplifiers(gains, 
+                                                          noise_dict, 
+                                                          offset_dict)
+    traps = calibration.traps
 
     ## Output filename
     base = os.path.splitext(os.path.basename(infile))[0]